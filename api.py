@@ -6,23 +6,45 @@ FastAPI + pgvector でベクトル検索を提供
 """
 
 import os
-from typing import List, Optional
+import base64
+import math
+import time
+from typing import List, Optional, Tuple
+import numpy as np
+import orjson
 from fastapi import FastAPI, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+import httpx
 import openai
 
 try:
     from supabase import create_client, Client
+    from supabase.lib.client_options import ClientOptions
 except ImportError:
     print("ERROR: supabase is not installed. Please run: pip install supabase")
     exit(1)
 
+# Numba があれば正規化をJITコンパイル（任意）
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# h2 があれば HTTP/2 で1本の接続に多重化（任意: pip install httpx[http2]）
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+
 # FastAPIアプリケーション
 app = FastAPI(
     title="CAD Explorer API",
     description="DXF図面の意味検索API",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS設定（開発用）
@@ -44,8 +66,28 @@ if not SUPABASE_KEY:
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY environment variable is not set")
 
-openai.api_key = OPENAI_API_KEY
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))  # 秒
+
+# 接続を使い回し、リクエストごとのTCP/TLSハンドシェイクを避ける
+http_client = httpx.AsyncClient(
+    http2=HTTP2_ENABLED,
+    limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+    timeout=httpx.Timeout(30.0)
+)
+openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+# Supabase クライアントはモジュールで1つだけ作成し、全リクエストで共有する
+# （PostgREST 用の同期クライアントも接続を使い回し、h2 があれば HTTP/2 で多重化）
+supabase_http_client = httpx.Client(
+    http2=HTTP2_ENABLED,
+    limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+    timeout=httpx.Timeout(SUPABASE_TIMEOUT)
+)
+try:
+    supabase_options = ClientOptions(postgrest_client_timeout=SUPABASE_TIMEOUT, httpx_client=supabase_http_client)
+except TypeError:
+    # httpx_client を渡せない古い supabase-py では既定のクライアントを使う
+    supabase_options = ClientOptions(postgrest_client_timeout=SUPABASE_TIMEOUT)
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY, options=supabase_options)
 
 
 # レスポンスモデル
@@ -74,17 +116,225 @@ class HealthResponse(BaseModel):
     entities_count: int
 
 
+# キャッシュ設定
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIM = 3072
+SEARCH_CACHE_TTL = 60  # 秒
+SEARCH_CACHE_MAX = 1024
+_search_cache: dict = {}
+EMBED_CACHE_MAX = 4096
+_embed_cache: dict = {}
+
+# フォールバック検索用の埋め込み行列（起動時・管理エンドポイントで更新）
+EMBEDDING_CACHE = {"version": None, "matrix": None, "scales": None, "ids": None, "meta": None}
+
+# EMBEDDING_QUANTIZE=int8 の場合、行列を行ごとのスケール付き int8 で保持する（メモリ1/4）
+EMBEDDING_QUANTIZE = os.getenv("EMBEDDING_QUANTIZE", "").lower()
+INT8_BLOCK_ROWS = 4096  # スコア計算時に float32 へ戻す行数（L2キャッシュに収まる程度）
+
+
 # ヘルパー関数
-def embed_query(query: str) -> List[float]:
-    """クエリをベクトルに変換"""
+def normalize_query(query: str) -> str:
+    """キャッシュキー用にクエリの空白を正規化"""
+    return " ".join(query.split())
+
+
+async def embed_query(query: str) -> List[float]:
+    """クエリをベクトルに変換（(モデル, 正規化済みクエリ) 単位でキャッシュ）"""
+    key = (EMBEDDING_MODEL, normalize_query(query))
+    cached = _embed_cache.get(key)
+    if cached is not None:
+        return list(cached)
+    
     try:
-        response = openai.embeddings.create(
-            model="text-embedding-3-large",
-            input=query
+        response = await openai_client.embeddings.create(
+            model=key[0],
+            input=key[1]
         )
-        return response.data[0].embedding
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
+    
+    embedding = tuple(response.data[0].embedding)
+    if len(_embed_cache) >= EMBED_CACHE_MAX:
+        _embed_cache.pop(next(iter(_embed_cache)))
+    _embed_cache[key] = embedding
+    return list(embedding)
+
+
+def decode_f32_embedding(value: str) -> np.ndarray:
+    """embeddings_f32 ビューの base64 (pgvector バイナリ形式) を float32 配列に変換"""
+    # vector_send の形式: int16 次元数 + int16 予約 + float4 (ビッグエンディアン) × 次元数
+    return np.frombuffer(base64.b64decode(value), dtype=">f4", offset=4).astype(np.float32)
+
+
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def normalize_inplace(v: np.ndarray) -> np.ndarray:
+        """ベクトルをその場でL2正規化（ループ融合・SIMD化）"""
+        s = 0.0
+        for x in v:
+            s += x * x
+        if s > 0.0:
+            inv = 1.0 / math.sqrt(s)
+            for i in range(v.shape[0]):
+                v[i] *= inv
+        return v
+
+    @njit(fastmath=True, cache=True)
+    def normalize_rows_inplace(matrix: np.ndarray) -> np.ndarray:
+        """行列の各行をその場でL2正規化"""
+        for r in range(matrix.shape[0]):
+            normalize_inplace(matrix[r])
+        return matrix
+else:
+    def normalize_inplace(v: np.ndarray) -> np.ndarray:
+        """ベクトルをその場でL2正規化"""
+        norm = np.sqrt(np.dot(v, v))
+        if norm > 0:
+            v *= 1.0 / norm
+        return v
+
+    def normalize_rows_inplace(matrix: np.ndarray) -> np.ndarray:
+        """行列の各行をその場でL2正規化"""
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+        return matrix
+
+
+def quantize_rows_int8(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """各行を max|x| / 127 のスケールで int8 に量子化（行 ≈ q * scale）"""
+    scales = np.abs(matrix).max(axis=1) / 127.0 if matrix.size else np.empty(0, dtype=np.float32)
+    scales = scales.astype(np.float32)
+    scales[scales == 0] = 1.0
+    quantized = np.empty(matrix.shape, dtype=np.int8)
+    # 一時配列が行列全体の大きさにならないようブロック単位で変換
+    for start in range(0, matrix.shape[0], INT8_BLOCK_ROWS):
+        end = start + INT8_BLOCK_ROWS
+        np.rint(matrix[start:end] / scales[start:end, None], out=matrix[start:end])
+        quantized[start:end] = matrix[start:end]
+    return quantized, scales
+
+
+def int8_scores(quantized: np.ndarray, scales: np.ndarray, query_vec: np.ndarray) -> np.ndarray:
+    """int8 行列とクエリの内積をブロックごとに float32 の sgemv で計算"""
+    n = quantized.shape[0]
+    scores = np.empty(n, dtype=np.float32)
+    buf = np.empty((min(n, INT8_BLOCK_ROWS), quantized.shape[1]), dtype=np.float32)
+    for start in range(0, n, INT8_BLOCK_ROWS):
+        block = quantized[start:start + INT8_BLOCK_ROWS]
+        tmp = buf[:block.shape[0]]
+        tmp[...] = block
+        np.dot(tmp, query_vec, out=scores[start:start + block.shape[0]])
+    scores *= scales
+    return scores
+
+
+def fetch_all_rows(table: str, columns: str, page_size: int = 1000) -> List[dict]:
+    """PostgRESTの最大行数制限を超えてテーブル全体をページングで取得"""
+    rows = []
+    offset = 0
+    while True:
+        result = supabase.table(table).select(columns).order("id").range(
+            offset, offset + page_size - 1
+        ).execute()
+        rows.extend(result.data)
+        if len(result.data) < page_size:
+            return rows
+        offset += page_size
+
+
+def refresh_embedding_cache() -> dict:
+    """全埋め込みを読み込み、L2正規化済みの float32 行列として EMBEDDING_CACHE に保持"""
+    try:
+        # float32 のバイト列で受け取る（JSONの浮動小数点テキストより転送量が小さい）
+        rows = fetch_all_rows(
+            "embeddings_f32", "id, drawing_id, entity_id, kind, payload, embedding_f32"
+        )
+        decode = lambda r: decode_f32_embedding(r["embedding_f32"])
+    except Exception as e:
+        # ビューが未作成の場合は embedding 列（"[0.1,0.2,...]" 形式の文字列）を読む
+        print(f"⚠️  embeddings_f32 view unavailable, reading text embeddings: {e}")
+        rows = fetch_all_rows("embeddings", "id, drawing_id, entity_id, kind, payload, embedding")
+        decode = lambda r: orjson.loads(r["embedding"]) if isinstance(r["embedding"], str) else r["embedding"]
+    
+    if rows:
+        # 行列を一度だけ確保し、行ごとに埋めてからその場で正規化する
+        first = np.asarray(decode(rows[0]), dtype=np.float32)
+        matrix = np.empty((len(rows), first.shape[0]), dtype=np.float32)
+        matrix[0] = first
+        for i in range(1, len(rows)):
+            matrix[i] = decode(rows[i])
+        normalize_rows_inplace(matrix)
+    else:
+        matrix = np.empty((0, 0), dtype=np.float32)
+    
+    scales = None
+    if EMBEDDING_QUANTIZE == "int8":
+        matrix, scales = quantize_rows_int8(matrix)
+    
+    EMBEDDING_CACHE["matrix"] = matrix
+    EMBEDDING_CACHE["scales"] = scales
+    EMBEDDING_CACHE["ids"] = np.fromiter((r["id"] for r in rows), dtype=np.int64, count=len(rows))
+    EMBEDDING_CACHE["meta"] = [
+        {k: r[k] for k in ("drawing_id", "entity_id", "kind", "payload")} for r in rows
+    ]
+    EMBEDDING_CACHE["version"] = time.time()
+    _search_cache.clear()
+    return EMBEDDING_CACHE
+
+
+def get_embedding_cache() -> dict:
+    """EMBEDDING_CACHE を返す（未読み込みなら読み込む）"""
+    if EMBEDDING_CACHE["matrix"] is None:
+        refresh_embedding_cache()
+    return EMBEDDING_CACHE
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコア上位k件のインデックスを降順で返す（全件ソートせず O(N + k log k)）"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+def local_vector_search(embedding: List[float], limit: int = 20) -> List[dict]:
+    """メモリ上の埋め込み行列でベクトル検索（RPCが使えない場合のフォールバック）"""
+    cache = get_embedding_cache()
+    meta, matrix = cache["meta"], cache["matrix"]
+    if not meta:
+        return []
+    
+    query_vec = normalize_inplace(np.array(embedding, dtype=np.float32))
+    
+    # 正規化済みなので内積 = コサイン類似度（BLAS sgemv 1回）
+    if cache["scales"] is not None:
+        scores = int8_scores(matrix, cache["scales"], query_vec)
+    else:
+        scores = matrix @ query_vec
+    top = top_k_indices(scores, limit)
+    
+    results = [{**meta[i], "score": float(scores[i])} for i in top]
+    
+    # RPCと同じ列（図面名・エンティティ情報）を埋め込みリソースで1回のリクエストで付与
+    ids = [int(cache["ids"][i]) for i in top]
+    if ids:
+        joined = supabase.table("embeddings").select(
+            "id, drawings(filename), entities(type, layer, text)"
+        ).in_("id", ids).execute()
+        joined_map = {row["id"]: row for row in joined.data}
+        for emb_id, r in zip(ids, results):
+            row = joined_map.get(emb_id, {})
+            drawing = row.get("drawings") or {}
+            entity = row.get("entities") or {}
+            r["filename"] = drawing.get("filename")
+            r["entity_type"] = entity.get("type")
+            r["layer"] = entity.get("layer")
+            r["text"] = entity.get("text")
+    
+    return results
 
 
 def vector_search(embedding: List[float], limit: int = 20) -> List[dict]:
@@ -101,36 +351,24 @@ def vector_search(embedding: List[float], limit: int = 20) -> List[dict]:
         
         return result.data
     except Exception as e:
-        # RPCが使えない場合は直接SQLで検索
-        # 注意: この方法はpython-supabaseの制限により完全には動作しない可能性があります
-        raise HTTPException(
-            status_code=500, 
-            detail=f"Vector search failed. Please create the RPC function: {str(e)}"
-        )
+        # RPCが未作成の場合（migration_embeddings.sql 未適用）はメモリ上で検索する
+        print(f"⚠️  search_embeddings RPC failed, falling back to in-memory search: {e}")
+        return local_vector_search(embedding, limit)
 
 
-def get_entity_details(entity_ids: List[str]) -> dict:
-    """エンティティの詳細情報を取得"""
-    if not entity_ids:
-        return {}
-    
-    result = supabase.table("entities").select(
-        "id, type, layer, text, drawing_id"
-    ).in_("id", entity_ids).execute()
-    
-    return {item["id"]: item for item in result.data}
-
-
-def get_drawing_details(drawing_ids: List[str]) -> dict:
-    """図面の詳細情報を取得"""
-    if not drawing_ids:
-        return {}
-    
-    result = supabase.table("drawings").select(
-        "id, filename"
-    ).in_("id", drawing_ids).execute()
-    
-    return {item["id"]: item for item in result.data}
+def get_table_counts() -> dict:
+    """embeddings / drawings / entities の件数を取得（RPC使用）"""
+    try:
+        # 3テーブル分の件数を1回のリクエストで取得
+        result = supabase.rpc('get_counts').execute()
+        return result.data[0] if isinstance(result.data, list) else result.data
+    except Exception as e:
+        # RPCが未作成の場合は件数のみのリクエストを3回行う
+        print(f"⚠️  get_counts RPC failed, falling back to per-table counts: {e}")
+        return {
+            table: supabase.table(table).select("id", count="exact", head=True).execute().count or 0
+            for table in ("embeddings", "drawings", "entities")
+        }
 
 
 # エンドポイント
@@ -142,25 +380,76 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "search": "/search?q=検索クエリ",
-            "health": "/health"
+            "health": "/health",
+            "refresh_embeddings": "POST /admin/embeddings/refresh"
         }
     }
 
 
+def warmup_vector_search():
+    """ダミーのクエリでRPCを1回実行し、HNSWインデックスと埋め込みのページを共有バッファに載せる"""
+    # ゼロベクトルはコサイン距離が定義されないため単位ベクトルを使う
+    unit = [0.0] * EMBEDDING_DIM
+    unit[0] = 1.0
+    try:
+        supabase.rpc(
+            'search_embeddings',
+            {
+                'query_embedding': unit,
+                'match_count': 1
+            }
+        ).execute()
+    except Exception as e:
+        # RPCが使えない場合は最初の検索がフォールバックになるため、行列を先に読み込む
+        print(f"⚠️  search_embeddings warmup failed, preloading fallback matrix: {e}")
+        refresh_embedding_cache()
+
+
+@app.on_event("startup")
+async def preload_embedding_cache():
+    """起動時に検索経路をウォームアップする（WARMUP_ON_STARTUP=0 で無効）
+    
+    PRELOAD_EMBEDDINGS=1 の場合はフォールバック用の埋め込み行列も読み込む
+    """
+    if os.getenv("PRELOAD_EMBEDDINGS") == "1":
+        refresh_embedding_cache()
+    if os.getenv("WARMUP_ON_STARTUP", "1") != "0":
+        try:
+            warmup_vector_search()
+        except Exception as e:
+            # ウォームアップの失敗で起動を止めない
+            print(f"⚠️  startup warmup failed: {e}")
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    """共有HTTPクライアントを閉じる"""
+    await http_client.aclose()
+    supabase_http_client.close()
+
+
+@app.post("/admin/embeddings/refresh", response_model=dict)
+async def refresh_embeddings():
+    """フォールバック用の埋め込み行列を再読み込み"""
+    try:
+        cache = refresh_embedding_cache()
+        return {"version": cache["version"], "count": len(cache["meta"])}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Embedding refresh failed: {str(e)}")
+
+
 @app.get("/health", response_model=HealthResponse)
 async def health():
     """ヘルスチェック"""
     try:
         # 統計情報を取得
-        embeddings = supabase.table("embeddings").select("id", count="exact").execute()
-        drawings = supabase.table("drawings").select("id", count="exact").execute()
-        entities = supabase.table("entities").select("id", count="exact").execute()
+        counts = get_table_counts()
         
         return HealthResponse(
             status="healthy",
-            embeddings_count=embeddings.count or 0,
-            drawings_count=drawings.count or 0,
-            entities_count=entities.count or 0
+            embeddings_count=counts["embeddings"] or 0,
+            drawings_count=counts["drawings"] or 0,
+            entities_count=counts["entities"] or 0
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Health check failed: {str(e)}")
@@ -181,82 +470,39 @@ async def search(
     - /search?q=Plan 1 レイヤー
     - /search?q=円形の図形
     """
+    # 同一クエリの短期キャッシュ
+    cache_key = (q, limit)
+    cached = _search_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < SEARCH_CACHE_TTL:
+        return cached[1]
+    
     try:
         # 1. クエリをベクトル化
-        query_embedding = embed_query(q)
-        
-        # 2. ベクトル検索を実行（手動でSQLクエリ）
-        # Supabaseのpython clientではvector検索が制限されているため、
-        # 一時的に全件取得してPython側で計算
-        
-        # より良い方法: PostgreSQL関数を使用
-        # まず、embeddings から全データを取得（少量なので許容）
-        all_embeddings = supabase.table("embeddings").select(
-            "id, drawing_id, entity_id, kind, payload, embedding"
-        ).execute()
-        
-        # コサイン類似度を計算
-        import numpy as np
-        
-        results = []
-        query_vec = np.array(query_embedding)
+        query_embedding = await embed_query(q)
         
-        for item in all_embeddings.data:
-            emb_vec = np.array(item["embedding"])
-            # コサイン類似度: 1 - コサイン距離
-            similarity = np.dot(query_vec, emb_vec) / (
-                np.linalg.norm(query_vec) * np.linalg.norm(emb_vec)
-            )
-            
-            results.append({
-                "drawing_id": item["drawing_id"],
-                "entity_id": item["entity_id"],
-                "kind": item["kind"],
-                "payload": item["payload"],
-                "score": float(similarity)
-            })
+        # 2. ベクトル検索を実行
+        # search_embeddings RPC（pgvector + HNSW）で上位 limit 件のみを取得する
+        # RPCが使えない場合はメモリ上の正規化済み行列で計算する
+        results = vector_search(query_embedding, limit)
         
-        # スコア順にソート
-        results.sort(key=lambda x: x["score"], reverse=True)
-        results = results[:limit]
+        # 3. 結果を整形（図面名・エンティティ情報はRPCで結合済み）
+        # 自前のRPC／キャッシュ由来で型が確定しているため、検証を省略して構築する
+        enriched_results = [SearchResult.model_construct(**r) for r in results]
         
-        # 3. エンティティと図面の詳細を取得
-        entity_ids = [r["entity_id"] for r in results if r["entity_id"]]
-        drawing_ids = list(set([r["drawing_id"] for r in results]))
-        
-        entities_map = get_entity_details(entity_ids)
-        drawings_map = get_drawing_details(drawing_ids)
-        
-        # 4. 結果を結合
-        enriched_results = []
-        for r in results:
-            result = SearchResult(
-                drawing_id=r["drawing_id"],
-                entity_id=r["entity_id"],
-                kind=r["kind"],
-                payload=r["payload"],
-                score=r["score"]
-            )
-            
-            # 図面情報を追加
-            if r["drawing_id"] in drawings_map:
-                result.filename = drawings_map[r["drawing_id"]]["filename"]
-            
-            # エンティティ情報を追加
-            if r["entity_id"] and r["entity_id"] in entities_map:
-                entity = entities_map[r["entity_id"]]
-                result.entity_type = entity.get("type")
-                result.layer = entity.get("layer")
-                result.text = entity.get("text")
-            
-            enriched_results.append(result)
-        
-        return SearchResponse(
+        response = SearchResponse.model_construct(
             query=q,
             results=enriched_results,
             count=len(enriched_results)
         )
         
+        # 期限切れのエントリを末尾に入れ直し、上限を超えたら最古のものから破棄
+        _search_cache.pop(cache_key, None)
+        if len(_search_cache) >= SEARCH_CACHE_MAX:
+            _search_cache.pop(next(iter(_search_cache)))
+        _search_cache[cache_key] = (time.monotonic(), response)
+        
+        return response
+        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
 
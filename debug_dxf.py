@@ -3,14 +3,14 @@
 デバッグ用：DXFファイルの全エンティティを表示
 """
 import sys
-import ezdxf
+from ezdxf.addons import iterdxf
 
 if len(sys.argv) < 2:
     print("Usage: python3 debug_dxf.py <dxf_file>")
     sys.exit(1)
 
-doc = ezdxf.readfile(sys.argv[1])
-msp = doc.modelspace()
+# ドキュメント全体を読み込まず、モデル空間のエンティティを逐次読み出す
+doc = iterdxf.opendxf(sys.argv[1])
 
 print(f"📄 ファイル: {sys.argv[1]}")
 print(f"バージョン: {doc.dxfversion}")
@@ -18,7 +18,8 @@ print(f"\n全エンティティ一覧:")
 print("="*60)
 
 entity_counts = {}
-for entity in msp:
+texts = []  # TEXT/MTEXT は走査中に集めて、2回目の読み込みを避ける
+for entity in doc.modelspace():
     etype = entity.dxftype()
     entity_counts[etype] = entity_counts.get(etype, 0) + 1
     
@@ -28,11 +29,15 @@ for entity in msp:
     if etype == 'TEXT':
         print(f"  → テキスト: '{entity.dxf.text}'")
         print(f"  → 位置: {entity.dxf.insert}")
+        texts.append(('TEXT', entity.dxf.text))
     
     # MTEXTの詳細
     if etype == 'MTEXT':
         text = getattr(entity, "plain_text", lambda: "")()
         print(f"  → テキスト: '{text}'")
+        texts.append(('MTEXT', text))
+
+doc.close()
 
 print(f"\n{'='*60}")
 print("エンティティ統計:")
@@ -40,15 +45,9 @@ for etype, count in sorted(entity_counts.items()):
     print(f"  {etype}: {count}件")
 
 print(f"\n📝 TEXT/MTEXTエンティティを検索...")
-text_found = False
-for entity in msp.query('TEXT MTEXT'):
-    text_found = True
-    if entity.dxftype() == 'TEXT':
-        print(f"  TEXT: '{entity.dxf.text}'")
-    else:
-        text = getattr(entity, "plain_text", lambda: "")()
-        print(f"  MTEXT: '{text}'")
+for etype, text in texts:
+    print(f"  {etype}: '{text}'")
 
-if not text_found:
+if not texts:
     print("  ⚠️ TEXT/MTEXTエンティティが見つかりませんでした")
 
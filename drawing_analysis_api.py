@@ -6,8 +6,9 @@ Drawing Analysis API
 """
 
 import os
+import asyncio
+import concurrent.futures
 import tempfile
-import shutil
 from pathlib import Path
 from typing import Optional, Dict, Any, List
 from datetime import datetime
@@ -15,12 +16,14 @@ import uuid
 
 from fastapi import FastAPI, File, UploadFile, HTTPException, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import BaseModel, Field, TypeAdapter
+import httpx
 import openai
+import aiofiles
 
 # ローカルモジュール
-from enhanced_dxf_parser import EnhancedDXFParser
+from enhanced_dxf_parser import parse_dxf_file
 
 # FastAPIアプリ
 app = FastAPI(
@@ -28,7 +31,8 @@ app = FastAPI(
     description="包括的な図面解析API - DXF/DWG/PDF/画像の自動解析、BOM生成、寸法抽出",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse
 )
 
 # CORS設定
@@ -43,14 +47,35 @@ app.add_middleware(
 # 環境変数
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 API_KEY = os.getenv("API_KEY", "dev-key-12345")  # 本番環境では必ず設定
-
-# OpenAI設定
-if OPENAI_API_KEY:
-    openai.api_key = OPENAI_API_KEY
+# DXF解析ワーカープロセス数（既定は CPU 数、最大4）
+PARSE_WORKERS = max(1, int(os.getenv("PARSE_WORKERS", min(4, os.cpu_count() or 1))))
+
+# h2 があれば HTTP/2 で1本の接続に多重化（任意: pip install httpx[http2]）
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+
+# OpenAI設定（接続を使い回し、リクエストごとのTCP/TLSハンドシェイクを避ける）
+http_client = httpx.AsyncClient(
+    http2=HTTP2_ENABLED,
+    limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+    timeout=httpx.Timeout(60.0)
+)
+openai_client = (
+    openai.AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+    if OPENAI_API_KEY else None
+)
 
 # 一時ファイル保存ディレクトリ
 UPLOAD_DIR = Path("./uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1MB
+
+# DXF解析用プロセスプール（ezdxfは純Pythonのため、スレッドではなくプロセスで並列化）
+# 起動時に作成する（インポートしただけではワーカーを起動しない）
+PROCESS_POOL: Optional[concurrent.futures.ProcessPoolExecutor] = None
 
 
 # ============================================
@@ -122,6 +147,10 @@ class AnalysisResult(BaseModel):
     error: Optional[str] = None
 
 
+# 寸法リストを1回の呼び出しでまとめて検証する
+DIMENSION_LIST_ADAPTER = TypeAdapter(List[DimensionInfo])
+
+
 class HealthResponse(BaseModel):
     """ヘルスチェック"""
     status: str
@@ -171,9 +200,9 @@ def detect_file_type(filename: str) -> str:
 async def analyze_dxf(filepath: Path) -> Dict[str, Any]:
     """DXFファイルを解析"""
     try:
-        parser = EnhancedDXFParser(filepath)
-        result = parser.parse()
-        return result
+        # CPU負荷の高い解析でイベントループをブロックしない
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(PROCESS_POOL, parse_dxf_file, str(filepath))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DXF parsing failed: {str(e)}")
 
@@ -222,7 +251,7 @@ async def analyze_image(filepath: Path) -> Dict[str, Any]:
 
 async def generate_llm_summary(analysis_data: Dict[str, Any]) -> Optional[str]:
     """LLMで自然言語要約を生成"""
-    if not OPENAI_API_KEY:
+    if openai_client is None:
         return None
     
     try:
@@ -238,7 +267,7 @@ async def generate_llm_summary(analysis_data: Dict[str, Any]) -> Optional[str]:
 要約（100文字以内）：
 """
         
-        response = openai.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "あなたは機械図面の解析専門家です。"},
@@ -258,6 +287,21 @@ async def generate_llm_summary(analysis_data: Dict[str, Any]) -> Optional[str]:
 # エンドポイント
 # ============================================
 
+@app.on_event("startup")
+async def start_process_pool():
+    """DXF解析用のプロセスプールを作成"""
+    global PROCESS_POOL
+    PROCESS_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+
+
+@app.on_event("shutdown")
+async def shutdown_process_pool():
+    """プロセスプールと共有HTTPクライアントを終了"""
+    if PROCESS_POOL is not None:
+        PROCESS_POOL.shutdown(wait=False, cancel_futures=True)
+    await http_client.aclose()
+
+
 @app.get("/", tags=["General"])
 async def root():
     """ルートエンドポイント"""
@@ -327,8 +371,10 @@ async def analyze_drawing(
     # 一時ファイルに保存
     temp_file = UPLOAD_DIR / f"{job_id}_{file.filename}"
     try:
-        with temp_file.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # イベントループをブロックしないよう非同期にチャンク書き込み
+        async with aiofiles.open(temp_file, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
         
         # ファイルタイプ別に解析
         if file_type == 'dxf':
@@ -346,11 +392,13 @@ async def analyze_drawing(
             llm_summary = await generate_llm_summary(analysis_data)
         
         # 要約を更新
-        summary = DrawingSummary(
+        # 解析結果は自前のパーサーが生成したものなので、寸法リストのみ一括検証し
+        # それ以外は検証を省略して構築する
+        summary = DrawingSummary.model_construct(
             natural_language_summary=llm_summary,
-            key_dimensions=[
-                DimensionInfo(**dim) for dim in analysis_data['summary']['key_dimensions']
-            ],
+            key_dimensions=DIMENSION_LIST_ADAPTER.validate_python(
+                analysis_data['summary']['key_dimensions']
+            ),
             materials=analysis_data['summary']['materials'],
             total_entities=analysis_data['summary']['total_entities'],
             has_bom=analysis_data['summary']['has_bom'],
@@ -358,7 +406,7 @@ async def analyze_drawing(
         )
         
         # 結果を構築
-        result = AnalysisResult(
+        result = AnalysisResult.model_construct(
             job_id=job_id,
             filename=file.filename,
             file_type=file_type,
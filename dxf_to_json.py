@@ -3,17 +3,34 @@
 
 import argparse
 import json
+import os
+import shutil
 import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
-from typing import Dict, Any, List, Union
+from typing import Dict, Any, List, Tuple, Union
+
+import numpy as np
 
 # You need: pip install ezdxf
 try:
     import ezdxf
+    from ezdxf.addons import iterdxf
+    from ezdxf.lldxf.const import acad_release
 except Exception as e:
     print("ERROR: ezdxf is not installed. Please run: pip install ezdxf", file=sys.stderr)
     raise
 
+try:
+    import orjson
+except Exception as e:
+    print("ERROR: orjson is not installed. Please run: pip install orjson", file=sys.stderr)
+    raise
+
 SAFE_ENTITY_TYPES = {
     "LINE", "CIRCLE", "ARC", "ELLIPSE",
     "LWPOLYLINE", "POLYLINE", "SPLINE",
@@ -36,135 +53,244 @@ def bbox_of_entity(e) -> Union[None, List[float]]:
     except Exception:
         return None
 
-def extract_basic(e) -> Dict[str, Any]:
+def xy(p) -> Tuple[float, float]:
+    # Plain tuple of the first two coordinates. Slicing does not work here:
+    # ezdxf's compiled Vec3 only accepts integer indices (p[:2] raises TypeError).
+    return (float(p[0]), float(p[1]))
+
+def _extract_line(e, dxf, d):
+    d["start"] = xy(dxf.start)
+    d["end"] = xy(dxf.end)
+
+def _extract_circle(e, dxf, d):
+    d["center"] = xy(dxf.center)
+    d["radius"] = float(dxf.radius)
+
+def _extract_arc(e, dxf, d):
+    d["center"] = xy(dxf.center)
+    d["radius"] = float(dxf.radius)
+    d["start_angle"] = float(dxf.start_angle)
+    d["end_angle"] = float(dxf.end_angle)
+
+def xy_columns(values, width: int) -> np.ndarray:
+    # ezdxf keeps vertices as a flat float64 array (width values per vertex);
+    # take (x, y) without a per-point Python loop. orjson dumps it via OPT_SERIALIZE_NUMPY.
+    return np.ascontiguousarray(np.asarray(values, dtype=np.float64).reshape(-1, width)[:, :2])
+
+def _extract_lwpolyline(e, dxf, d):
+    try:
+        # lwpoints: (x, y, start_width, end_width, bulge) per vertex
+        pts = xy_columns(e.lwpoints.values, 5)
+        d["is_closed"] = bool(e.closed)
+        d["points"] = pts
+    except Exception:
+        pass
+
+def _extract_polyline(e, dxf, d):
+    try:
+        pts = [xy(v.dxf.location) for v in e.vertices()]
+        d["is_closed"] = bool(e.is_closed)
+        d["points"] = pts
+    except Exception:
+        pass
+
+def _extract_ellipse(e, dxf, d):
+    d["center"] = xy(dxf.center)
+    d["major_axis"] = xy(dxf.major_axis)
+    d["ratio"] = float(dxf.radius_ratio)
+
+def _extract_spline(e, dxf, d):
+    try:
+        # fit_points: (x, y, z) per vertex
+        fit_points = xy_columns(e.fit_points.values, 3)
+        d["fit_points"] = fit_points
+    except Exception:
+        pass
+
+def _extract_point(e, dxf, d):
+    d["location"] = xy(dxf.location)
+
+def _extract_text(e, dxf, d):
+    d["text"] = dxf.text
+    d["position"] = xy(dxf.insert)
+
+def _extract_mtext(e, dxf, d):
+    # MTEXT content is not a DXF attribute; fall back to plain_text()
+    d["text"] = dxf.text if hasattr(dxf, "text") else getattr(e, "plain_text", lambda: "")()
+    d["position"] = xy(dxf.insert)
+
+def _extract_dimension(e, dxf, d):
+    # ezdxf stores the measurement in various places depending on the style.
+    # We extract what we safely can.
+    d["text"] = dxf.text
+    # measurement might be available via dimtype specific interface
+    try:
+        d["measurement"] = float(e.measurement)
+    except Exception:
+        d["measurement"] = None
+
+def _extract_hatch(e, dxf, d):
+    d["solid_fill"] = bool(dxf.solid_fill)
+    d["pattern_name"] = dxf.pattern_name
+
+def _extract_insert(e, dxf, d):
+    # Block reference (e.g., title blocks, symbols)
+    d["name"] = dxf.name
+    try:
+        d["insert"] = xy(dxf.insert)
+        d["xscale"] = float(dxf.xscale)
+        d["yscale"] = float(dxf.yscale)
+        d["rotation"] = float(dxf.rotation)
+    except Exception:
+        pass
+
+def _extract_default(e, dxf, d):
+    pass
+
+# Geometry fields per type (safe ones only)
+EXTRACTORS = {
+    "LINE": _extract_line,
+    "CIRCLE": _extract_circle,
+    "ARC": _extract_arc,
+    "LWPOLYLINE": _extract_lwpolyline,
+    "POLYLINE": _extract_polyline,
+    "ELLIPSE": _extract_ellipse,
+    "SPLINE": _extract_spline,
+    "POINT": _extract_point,
+    "TEXT": _extract_text,
+    "MTEXT": _extract_mtext,
+    "DIMENSION": _extract_dimension,
+    "HATCH": _extract_hatch,
+    "INSERT": _extract_insert,
+}
+
+def extract_basic(e, t: str = None) -> Dict[str, Any]:
+    # All SAFE_ENTITY_TYPES are graphical entities, so the common attributes always exist
+    dxf = e.dxf
+    if t is None:
+        t = e.dxftype()
     d = {
-        "type": e.dxftype(),
-        "layer": e.dxf.layer if hasattr(e, "dxf") and hasattr(e.dxf, "layer") else None,
-        "color": getattr(e.dxf, "color", None),
-        "linetype": getattr(e.dxf, "linetype", None),
-        "lineweight": getattr(e.dxf, "lineweight", None),
+        "type": t,
+        "layer": dxf.layer,
+        "color": dxf.color,
+        "linetype": dxf.linetype,
+        "lineweight": dxf.lineweight,
         "bbox": bbox_of_entity(e),
     }
-    t = d["type"]
-
-    # Geometry fields per type (safe ones only)
     try:
-        if t == "LINE":
-            d["start"] = list(map(float, e.dxf.start[:2]))
-            d["end"] = list(map(float, e.dxf.end[:2]))
-        elif t == "CIRCLE":
-            d["center"] = list(map(float, e.dxf.center[:2]))
-            d["radius"] = float(e.dxf.radius)
-        elif t == "ARC":
-            d["center"] = list(map(float, e.dxf.center[:2]))
-            d["radius"] = float(e.dxf.radius)
-            d["start_angle"] = float(e.dxf.start_angle)
-            d["end_angle"] = float(e.dxf.end_angle)
-        elif t in ("LWPOLYLINE", "POLYLINE"):
-            try:
-                pts = []
-                if t == "LWPOLYLINE":
-                    pts = [list(map(float, (p[0], p[1]))) for p in e.get_points()]
-                    d["is_closed"] = bool(e.closed)
-                else:
-                    pts = [list(map(float, (v.dxf.location[0], v.dxf.location[1]))) for v in e.vertices()]
-                    d["is_closed"] = bool(e.is_closed)
-                d["points"] = pts
-            except Exception:
-                pass
-        elif t == "ELLIPSE":
-            d["center"] = list(map(float, e.dxf.center[:2]))
-            d["major_axis"] = list(map(float, e.dxf.major_axis[:2]))
-            d["ratio"] = float(e.dxf.radius_ratio)
-        elif t == "SPLINE":
-            try:
-                fit_points = [list(map(float, (p[0], p[1]))) for p in e.fit_points]
-                d["fit_points"] = fit_points
-            except Exception:
-                pass
-        elif t == "POINT":
-            d["location"] = list(map(float, e.dxf.location[:2]))
-        elif t in ("TEXT", "MTEXT"):
-            d["text"] = e.dxf.text if hasattr(e.dxf, "text") else getattr(e, "plain_text", lambda: "")()
-            # Position
-            if hasattr(e.dxf, "insert"):
-                d["position"] = list(map(float, e.dxf.insert[:2]))
-        elif t == "DIMENSION":
-            # ezdxf stores the measurement in various places depending on the style.
-            # We extract what we safely can.
-            d["text"] = getattr(e.dxf, "text", None)
-            # measurement might be available via dimtype specific interface
-            try:
-                d["measurement"] = float(e.measurement)
-            except Exception:
-                d["measurement"] = None
-        elif t == "HATCH":
-            d["solid_fill"] = bool(getattr(e.dxf, "solid_fill", 0))
-            d["pattern_name"] = getattr(e.dxf, "pattern_name", None)
-        elif t == "INSERT":
-            # Block reference (e.g., title blocks, symbols)
-            d["name"] = e.dxf.name if hasattr(e.dxf, "name") else None
-            try:
-                d["insert"] = list(map(float, e.dxf.insert[:2]))
-                d["xscale"] = float(getattr(e.dxf, "xscale", 1.0))
-                d["yscale"] = float(getattr(e.dxf, "yscale", 1.0))
-                d["rotation"] = float(getattr(e.dxf, "rotation", 0.0))
-            except Exception:
-                pass
+        EXTRACTORS.get(t, _extract_default)(e, dxf, d)
     except Exception:
         # Be forgiving; we don't want to crash the whole run for a single odd entity
         pass
     return d
 
-def parse_dxf(path: Path) -> Dict[str, Any]:
-    doc = ezdxf.readfile(str(path))
-    msp = doc.modelspace()
-    ents = []
-    counts = {}
-    for e in msp:
+def iter_entities(entities, counts: Counter):
+    # Single pass: tally every type into counts, yield records for the safe ones.
+    # (msp.query() is itself a Python-level walk over all entities, so a
+    # query prefilter plus a separate count pass would iterate twice.)
+    for e in entities:
         t = e.dxftype()
-        if t not in SAFE_ENTITY_TYPES:
-            counts[t] = counts.get(t, 0) + 1
-            continue
+        counts[t] += 1
+        if t in SAFE_ENTITY_TYPES:
+            try:
+                yield extract_basic(e, t)
+            except Exception:
+                continue
+
+@contextmanager
+def open_modelspace(path: Path, stream: bool = False):
+    # Yields (model-space entities, info). info["layers"] is complete once the
+    # entities have been exhausted.
+    if stream:
+        # Stream model-space entities without building the whole document in memory.
+        # The LAYER table is not loaded, so layers are the ones referenced by entities.
+        doc = iterdxf.opendxf(str(path))
+        info = {"layers": [], "version": acad_release.get(doc.dxfversion)}
+        seen = set()
+
+        def tracked():
+            for e in doc.modelspace():
+                layer = e.dxf.get("layer")
+                if layer is not None and layer not in seen:
+                    seen.add(layer)
+                    info["layers"].append(layer)
+                yield e
+
         try:
-            rec = extract_basic(e)
-            ents.append(rec)
-            counts[t] = counts.get(t, 0) + 1
+            yield tracked(), info
+        finally:
+            doc.close()
+    else:
+        doc = ezdxf.readfile(str(path))
+        try:
+            layers = [layer.dxf.name for layer in doc.layers] if hasattr(doc, "layers") else []
         except Exception:
-            counts[t] = counts.get(t, 0) + 1
-            continue
+            layers = []
+        yield doc.modelspace(), {"layers": layers, "version": getattr(doc, "acad_release", None)}
 
-    try:
-        layers = [layer.dxf.name for layer in doc.layers] if hasattr(doc, "layers") else []
-    except Exception:
-        layers = []
-    meta = {
+def build_meta(path: Path, info: Dict[str, Any], counts: Counter, sampled: int) -> Dict[str, Any]:
+    return {
         "filename": path.name,
         "path": str(path),
-        "version": getattr(doc, "acad_release", None),
-        "layer_count": len(layers),
-        "layers": layers,
-        "entity_counts": counts,
-        "entity_sampled": len(ents),
+        "version": info["version"],
+        "layer_count": len(info["layers"]),
+        "layers": info["layers"],
+        "entity_counts": dict(counts),
+        "entity_sampled": sampled,
     }
-    return {"meta": meta, "entities": ents}
+
+def parse_dxf(path: Path, stream: bool = False) -> Dict[str, Any]:
+    counts = Counter()
+    with open_modelspace(path, stream) as (entities, info):
+        ents = list(iter_entities(entities, counts))
+    return {"meta": build_meta(path, info, counts, len(ents)), "entities": ents}
+
+JSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
 
 def write_json(data: Dict[str, Any], out_path: Path):
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    with out_path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # orjson writes UTF-8 bytes directly (same output as ensure_ascii=False)
+    out_path.write_bytes(orjson.dumps(data, option=JSON_OPTIONS))
 
-def process_file(src: Path, out_dir: Path) -> Dict[str, Any]:
+def convert_dxf(src: Path, out_path: Path, stream: bool = False) -> Dict[str, Any]:
+    # Same output as write_json(parse_dxf(src)), but entity records are encoded
+    # one at a time into a temp file, so the full list is never held in memory.
+    # meta (which needs the final counts) is written first, then the records are copied in.
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    counts = Counter()
+    sampled = 0
+    with tempfile.TemporaryFile(dir=out_path.parent) as tmp:
+        with open_modelspace(src, stream) as (entities, info):
+            for rec in iter_entities(entities, counts):
+                # JSON strings never contain raw newlines, so re-indenting by
+                # replacing b"\n" is safe
+                if sampled:
+                    tmp.write(b",\n")
+                tmp.write(b"    " + orjson.dumps(rec, option=JSON_OPTIONS).replace(b"\n", b"\n    "))
+                sampled += 1
+        meta = build_meta(src, info, counts, sampled)
+        tmp.seek(0)
+        with out_path.open("wb") as f:
+            f.write(b'{\n  "meta": ')
+            f.write(orjson.dumps(meta, option=JSON_OPTIONS).replace(b"\n", b"\n  "))
+            if sampled:
+                f.write(b',\n  "entities": [\n')
+                shutil.copyfileobj(tmp, f)
+                f.write(b"\n  ]\n}")
+            else:
+                f.write(b',\n  "entities": []\n}')
+    return meta
+
+def process_file(src: Path, out_dir: Path, stream: bool = False) -> Dict[str, Any]:
     try:
-        data = parse_dxf(src)
         out_file = out_dir / (src.stem + ".json")
-        write_json(data, out_file)
+        meta = convert_dxf(src, out_file, stream=stream)
         return {
             "file": str(src),
             "ok": True,
             "json": str(out_file),
-            "entities": data["meta"]["entity_counts"],
-            "layers": data["meta"]["layer_count"],
+            "entities": meta["entity_counts"],
+            "layers": meta["layer_count"],
         }
     except Exception as e:
         return {"file": str(src), "ok": False, "error": str(e)}
@@ -181,24 +307,29 @@ def main():
     ap.add_argument("input", help="DXF file or directory")
     ap.add_argument("-o", "--out", default="out_json", help="Output directory for JSON files")
     ap.add_argument("--index", action="store_true", help="Write index.jsonl with per-file summary")
+    ap.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    ap.add_argument("--stream", action="store_true",
+                    help="Stream model-space entities with iterdxf (low memory; layers are taken from entities)")
     args = ap.parse_args()
 
     src = Path(args.input)
     out_dir = Path(args.out)
     summaries = []
 
-    found = False
-    for dxf_path in iter_dxf_files(src):
-        found = True
-        s = process_file(dxf_path, out_dir)
-        summaries.append(s)
-        status = "OK" if s.get("ok") else "FAIL"
-        print(f"[{status}] {dxf_path}")
-
-    if not found:
+    dxf_files = list(iter_dxf_files(src))
+    if not dxf_files:
         print("No DXF files found.", file=sys.stderr)
         sys.exit(1)
 
+    # Each file is independent and CPU-bound (ezdxf parse + JSON encode)
+    jobs = args.jobs or os.cpu_count() or 1
+    chunksize = max(1, len(dxf_files) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as ex:
+        for dxf_path, s in zip(dxf_files, ex.map(partial(process_file, out_dir=out_dir, stream=args.stream), dxf_files, chunksize=chunksize)):
+            summaries.append(s)
+            status = "OK" if s.get("ok") else "FAIL"
+            print(f"[{status}] {dxf_path}")
+
     if args.index:
         out_dir.mkdir(parents=True, exist_ok=True)
         idx_path = out_dir / "index.jsonl"
@@ -6,8 +6,10 @@
 """
 
 import argparse
+import heapq
 import json
 import sys
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, Any, List, Optional
 import re
@@ -18,6 +20,109 @@ except ImportError:
     print("ERROR: ezdxf is not installed. Please run: pip install ezdxf", file=sys.stderr)
     sys.exit(1)
 
+# orjson があれば JSON 出力に使う（任意。なければ標準の json）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# pyahocorasick があればキーワード照合を1回の走査で行う（任意）
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+# テキスト分類用パターン（キーワードは部分一致。モジュール読み込み時に1回だけコンパイル）
+MATERIAL_KEYWORDS = ['SUS', 'SS', 'STEEL', 'ALUMINUM', 'AL', 'BRASS',
+                     '鋼', 'アルミ', 'ステンレス', '材質']
+TOLERANCE_KEYWORDS = ['±', 'TOL', 'H7', 'G6', 'JS', 'Ra', 'Rz']
+SURFACE_FINISH_KEYWORDS = ['Ra', 'Rz', '▽']
+
+MATERIAL_RE = re.compile('|'.join(map(re.escape, MATERIAL_KEYWORDS)))
+TOLERANCE_RE = re.compile('|'.join(map(re.escape, TOLERANCE_KEYWORDS)))
+THREAD_RE = re.compile(r'M\d+|UNC|UNF|Rc|Rp|PT')
+SURFACE_FINISH_RE = re.compile('|'.join(map(re.escape, SURFACE_FINISH_KEYWORDS)))
+DIMENSION_VALUE_RE = re.compile(r'^[\d.±]+$')
+
+if ahocorasick is not None:
+    # 材質・公差キーワードをまとめた1つのオートマトン（値はカテゴリ）
+    KEYWORD_AUTOMATON = ahocorasick.Automaton()
+    for _category, _keywords in (("material", MATERIAL_KEYWORDS), ("tolerance", TOLERANCE_KEYWORDS)):
+        for _kw in _keywords:
+            if _kw not in KEYWORD_AUTOMATON:
+                KEYWORD_AUTOMATON.add_word(_kw, _category)
+    KEYWORD_AUTOMATON.make_automaton()
+else:
+    KEYWORD_AUTOMATON = None
+
+
+@lru_cache(maxsize=4096)
+def classify_text(text: str) -> str:
+    """テキストの種類を分類（同じ注記は図面内・図面間で繰り返されるのでキャッシュする）"""
+    text_upper = text.upper()
+    
+    if KEYWORD_AUTOMATON is not None:
+        # 材質・公差キーワードを1回の走査で照合（材質を優先）
+        category = None
+        for _, category in KEYWORD_AUTOMATON.iter(text_upper):
+            if category == "material":
+                return "material"
+        if category:
+            return category
+    else:
+        # 材質パターン
+        if MATERIAL_RE.search(text_upper):
+            return "material"
+        
+        # 公差パターン
+        if TOLERANCE_RE.search(text_upper):
+            return "tolerance"
+    
+    # タップ・ねじパターン
+    if THREAD_RE.search(text):
+        return "thread"
+    
+    # 表面粗さパターン
+    if SURFACE_FINISH_RE.search(text):
+        return "surface_finish"
+    
+    # 数値のみ（寸法候補）
+    if DIMENSION_VALUE_RE.match(text.strip()):
+        return "dimension_value"
+    
+    return "annotation"
+
+
+# 幾何学的エンティティの抽出対象と、タイプ別の幾何情報（None は幾何情報なし）
+ENTITY_GEOMETRY = {
+    'LINE': lambda dxf: (
+        (float(dxf.start.x), float(dxf.start.y)),
+        (float(dxf.end.x), float(dxf.end.y))
+    ),
+    'CIRCLE': lambda dxf: (
+        (float(dxf.center.x), float(dxf.center.y)),
+        float(dxf.radius)
+    ),
+    'ARC': lambda dxf: (
+        (float(dxf.center.x), float(dxf.center.y)),
+        float(dxf.radius),
+        float(dxf.start_angle),
+        float(dxf.end_angle)
+    ),
+    'LWPOLYLINE': None,
+    'POLYLINE': None,
+    'SPLINE': None,
+    'ELLIPSE': None,
+}
+ENTITY_GEOMETRY_FIELDS = {
+    'LINE': ('start', 'end'),
+    'CIRCLE': ('center', 'radius'),
+    'ARC': ('center', 'radius', 'start_angle', 'end_angle'),
+}
+# 結果に含めるエンティティ辞書の上限（それ以降は件数のみ数える）
+ENTITY_PREVIEW_LIMIT = 100
+
 
 class EnhancedDXFParser:
     """拡張DXF解析クラス"""
@@ -31,193 +136,209 @@ class EnhancedDXFParser:
         self.dimensions = []
         self.texts = []
         self.tables = []  # BOMテーブル候補
-        self.entities = []
+        self._entity_counts = {}  # タイプ別の件数
+        self._entity_preview = {}  # タイプ別の先頭 ENTITY_PREVIEW_LIMIT 件
         self.annotations = []
         self.material_info = []
         
     def parse(self) -> Dict[str, Any]:
         """すべての情報を解析"""
-        self._extract_dimensions()
-        self._extract_texts()
-        self._extract_tables()
-        self._extract_entities()
+        self._extract_all()
         self._extract_material_info()
         self._extract_metadata()
         
         return self._compile_results()
     
+    def _extract_all(self):
+        """モデル空間を1回だけ走査し、タイプ別のハンドラに振り分ける"""
+        self._reset_geometry()
+        for entity in self.msp:
+            dxftype = entity.dxftype()
+            handler = DISPATCH.get(dxftype)
+            if handler:
+                handler(self, entity, dxftype)
+        self._finalize_geometry()
+    
     def _extract_dimensions(self):
         """寸法情報を抽出"""
         for entity in self.msp.query('DIMENSION'):
-            try:
-                dim_data = {
-                    "type": entity.dxftype(),
-                    "layer": entity.dxf.layer if hasattr(entity.dxf, 'layer') else None,
-                    "measurement": None,
-                    "text": None,
-                    "position": None,
-                    "confidence": 1.0  # ベクターデータなので信頼度は高い
-                }
-                
-                # 測定値を取得
-                try:
-                    dim_data["measurement"] = float(entity.measurement)
-                except:
-                    pass
-                
-                # 寸法テキストを取得
-                if hasattr(entity.dxf, 'text'):
-                    dim_data["text"] = entity.dxf.text
-                
-                # 位置情報
-                if hasattr(entity.dxf, 'defpoint'):
-                    defpoint = entity.dxf.defpoint
-                    dim_data["position"] = [float(defpoint.x), float(defpoint.y)]
-                
-                self.dimensions.append(dim_data)
-            except Exception as e:
-                continue
+            self._handle_dimension(entity, 'DIMENSION')
     
     def _extract_texts(self):
         """テキスト情報を抽出（注記、材質、公差など）"""
         for entity in self.msp.query('TEXT MTEXT'):
-            try:
-                # テキスト内容を取得
-                if entity.dxftype() == 'TEXT':
-                    text_content = entity.dxf.text if hasattr(entity.dxf, 'text') else ""
-                else:  # MTEXT
-                    text_content = getattr(entity, "plain_text", lambda: "")()
-                
-                # 不正なUnicode文字を除去
-                if text_content:
-                    text_content = text_content.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
-                
-                if not text_content or not text_content.strip():
-                    continue
-                
-                text_data = {
-                    "content": text_content,
-                    "layer": entity.dxf.layer if hasattr(entity.dxf, 'layer') else None,
-                    "position": None,
-                    "height": getattr(entity.dxf, 'height', None),
-                    "category": self._classify_text(text_content),
-                    "confidence": 1.0
-                }
-                
-                # 位置情報
-                if hasattr(entity.dxf, 'insert'):
-                    insert = entity.dxf.insert
-                    text_data["position"] = [float(insert.x), float(insert.y)]
-                
-                self.texts.append(text_data)
-                
-                # カテゴリ別に振り分け
-                if text_data["category"] == "material":
-                    self.material_info.append(text_data)
-                elif text_data["category"] == "annotation":
-                    self.annotations.append(text_data)
-                    
-            except Exception as e:
-                import sys
-                print(f"⚠️  Text extraction error: {e}", file=sys.stderr)
-                import traceback
-                traceback.print_exc()
-                continue
-    
-    def _classify_text(self, text: str) -> str:
-        """テキストの種類を分類"""
-        text_upper = text.upper()
-        
-        # 材質パターン
-        material_keywords = ['SUS', 'SS', 'STEEL', 'ALUMINUM', 'AL', 'BRASS', 
-                           '鋼', 'アルミ', 'ステンレス', '材質']
-        if any(kw in text_upper for kw in material_keywords):
-            return "material"
-        
-        # 公差パターン
-        tolerance_keywords = ['±', '±', 'TOL', 'H7', 'G6', 'JS', 'Ra', 'Rz']
-        if any(kw in text_upper for kw in tolerance_keywords):
-            return "tolerance"
-        
-        # タップ・ねじパターン
-        thread_pattern = r'M\d+|UNC|UNF|Rc|Rp|PT'
-        if re.search(thread_pattern, text):
-            return "thread"
-        
-        # 表面粗さパターン
-        if 'Ra' in text or 'Rz' in text or '▽' in text:
-            return "surface_finish"
-        
-        # 数値のみ（寸法候補）
-        if re.match(r'^[\d.±]+$', text.strip()):
-            return "dimension_value"
-        
-        return "annotation"
+            self._handle_text(entity, entity.dxftype())
     
     def _extract_tables(self):
         """テーブル（BOM候補）を抽出"""
         # TABLEエンティティまたはBLOCKから部品表を検出
         for entity in self.msp.query('INSERT'):
-            try:
-                block_name = entity.dxf.name if hasattr(entity.dxf, 'name') else None
-                
-                # BOMらしいブロック名をチェック
-                if block_name and any(keyword in block_name.upper() for keyword in 
-                                     ['BOM', 'PARTS', 'LIST', '部品表', '部品リスト']):
-                    position = None
-                    if hasattr(entity.dxf, 'insert'):
-                        insert = entity.dxf.insert
-                        position = [float(insert.x), float(insert.y)]
-                    table_data = {
-                        "name": block_name,
-                        "position": position,
-                        "type": "bom_candidate",
-                        "confidence": 0.7  # ヒューリスティックなので中程度の信頼度
-                    }
-                    self.tables.append(table_data)
-            except:
-                continue
+            self._handle_insert(entity, 'INSERT')
     
     def _extract_entities(self):
-        """幾何学的エンティティを抽出"""
-        entity_types = ['LINE', 'CIRCLE', 'ARC', 'LWPOLYLINE', 'POLYLINE', 
-                       'SPLINE', 'ELLIPSE']
-        
-        for etype in entity_types:
+        """幾何学的エンティティを抽出（件数とプレビューのみ保持）"""
+        self._reset_geometry()
+        for etype in ENTITY_GEOMETRY:
             for entity in self.msp.query(etype):
+                self._handle_geometry(entity, etype)
+        self._finalize_geometry()
+    
+    def _handle_dimension(self, entity, dxftype: str):
+        """寸法エンティティ1件を処理"""
+        try:
+            dxf = entity.dxf  # 属性アクセスごとの dxf 名前空間の参照を1回にまとめる
+            dim_data = {
+                "type": dxftype,
+                "layer": getattr(dxf, 'layer', None),
+                "measurement": None,
+                "text": None,
+                "position": None,
+                "confidence": 1.0  # ベクターデータなので信頼度は高い
+            }
+            
+            # 測定値を取得
+            try:
+                dim_data["measurement"] = float(entity.measurement)
+            except:
+                pass
+            
+            # 寸法テキストを取得
+            dim_data["text"] = getattr(dxf, 'text', None)
+            
+            # 位置情報
+            try:
+                defpoint = dxf.defpoint
+            except AttributeError:
+                pass
+            else:
+                dim_data["position"] = [float(defpoint.x), float(defpoint.y)]
+            
+            self.dimensions.append(dim_data)
+        except Exception as e:
+            pass
+    
+    def _handle_text(self, entity, dxftype: str):
+        """TEXT/MTEXTエンティティ1件を処理"""
+        try:
+            dxf = entity.dxf
+            # テキスト内容を取得
+            if dxftype == 'TEXT':
+                text_content = getattr(dxf, 'text', "")
+            else:  # MTEXT
+                text_content = getattr(entity, "plain_text", lambda: "")()
+            
+            # 不正なUnicode文字を除去
+            if text_content:
+                text_content = text_content.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
+            
+            if not text_content or not text_content.strip():
+                return
+            
+            text_data = {
+                "content": text_content,
+                "layer": getattr(dxf, 'layer', None),
+                "position": None,
+                "height": getattr(dxf, 'height', None),
+                "category": self._classify_text(text_content),
+                "confidence": 1.0
+            }
+            
+            # 位置情報
+            try:
+                insert = dxf.insert
+            except AttributeError:
+                pass
+            else:
+                text_data["position"] = [float(insert.x), float(insert.y)]
+            
+            self.texts.append(text_data)
+            
+            # カテゴリ別に振り分け
+            if text_data["category"] == "material":
+                self.material_info.append(text_data)
+            elif text_data["category"] == "annotation":
+                self.annotations.append(text_data)
+                
+        except Exception as e:
+            import sys
+            print(f"⚠️  Text extraction error: {e}", file=sys.stderr)
+            import traceback
+            traceback.print_exc()
+    
+    def _classify_text(self, text: str) -> str:
+        """テキストの種類を分類"""
+        return classify_text(text)
+    
+    def _handle_insert(self, entity, dxftype: str):
+        """ブロック参照1件を処理（BOMらしいブロック名ならテーブル候補に追加）"""
+        try:
+            dxf = entity.dxf
+            block_name = getattr(dxf, 'name', None)
+            
+            # BOMらしいブロック名をチェック
+            if block_name and any(keyword in block_name.upper() for keyword in 
+                                 ['BOM', 'PARTS', 'LIST', '部品表', '部品リスト']):
                 try:
-                    entity_data = {
-                        "type": entity.dxftype(),
-                        "layer": entity.dxf.layer if hasattr(entity.dxf, 'layer') else None,
-                        "color": getattr(entity.dxf, 'color', None),
-                    }
-                    
-                    # タイプ別の幾何情報
-                    if etype == 'CIRCLE':
-                        center = entity.dxf.center
-                        entity_data["geometry"] = {
-                            "center": [float(center.x), float(center.y)],
-                            "radius": float(entity.dxf.radius)
-                        }
-                    elif etype == 'LINE':
-                        start = entity.dxf.start
-                        end = entity.dxf.end
-                        entity_data["geometry"] = {
-                            "start": [float(start.x), float(start.y)],
-                            "end": [float(end.x), float(end.y)]
-                        }
-                    elif etype == 'ARC':
-                        center = entity.dxf.center
-                        entity_data["geometry"] = {
-                            "center": [float(center.x), float(center.y)],
-                            "radius": float(entity.dxf.radius),
-                            "start_angle": float(entity.dxf.start_angle),
-                            "end_angle": float(entity.dxf.end_angle)
-                        }
-                    
-                    self.entities.append(entity_data)
-                except:
-                    continue
+                    insert = dxf.insert
+                except AttributeError:
+                    position = None
+                else:
+                    position = [float(insert.x), float(insert.y)]
+                table_data = {
+                    "name": block_name,
+                    "position": position,
+                    "type": "bom_candidate",
+                    "confidence": 0.7  # ヒューリスティックなので中程度の信頼度
+                }
+                self.tables.append(table_data)
+        except:
+            pass
+    
+    def _reset_geometry(self):
+        """タイプ別の件数とプレビューを初期化（ENTITY_GEOMETRY の順に並べる）"""
+        self._entity_counts = dict.fromkeys(ENTITY_GEOMETRY, 0)
+        self._entity_preview = {etype: [] for etype in ENTITY_GEOMETRY}
+    
+    def _handle_geometry(self, entity, dxftype: str):
+        """幾何学的エンティティ1件を数え、先頭 ENTITY_PREVIEW_LIMIT 件のみ辞書化"""
+        preview = self._entity_preview[dxftype]
+        if len(preview) >= ENTITY_PREVIEW_LIMIT:
+            self._entity_counts[dxftype] += 1
+            return
+        try:
+            dxf = entity.dxf
+            entity_data = {
+                "type": dxftype,
+                "layer": getattr(dxf, 'layer', None),
+                "color": getattr(dxf, 'color', None),
+            }
+            getter = ENTITY_GEOMETRY[dxftype]
+            if getter:
+                entity_data["geometry"] = dict(zip(ENTITY_GEOMETRY_FIELDS[dxftype], getter(dxf)))
+        except:
+            return
+        preview.append(entity_data)
+        self._entity_counts[dxftype] += 1
+    
+    def _finalize_geometry(self):
+        """1件もなかったタイプを除く"""
+        for etype in [etype for etype, count in self._entity_counts.items() if not count]:
+            del self._entity_counts[etype]
+            del self._entity_preview[etype]
+    
+    @property
+    def entities_count(self) -> int:
+        """抽出した幾何学的エンティティの総数"""
+        return sum(self._entity_counts.values())
+    
+    def _entity_items(self, limit: int) -> List[Dict[str, Any]]:
+        """タイプ順に先頭 limit 件のプレビューを返す"""
+        items = []
+        for preview in self._entity_preview.values():
+            items.extend(preview[:limit - len(items)])
+            if len(items) >= limit:
+                break
+        return items
     
     def _extract_material_info(self):
         """材質情報を抽出（既にテキスト解析で分類済み）"""
@@ -262,45 +383,60 @@ class EnhancedDXFParser:
                 "bom_candidates": self.tables
             },
             "entities": {
-                "count": len(self.entities),
+                "count": self.entities_count,
                 "summary": self._summarize_entities(),
-                "items": self.entities[:100]  # 最初の100個のみ（APIでは全件返す）
+                "items": self._entity_items(ENTITY_PREVIEW_LIMIT)  # 最初の100個のみ
             },
             "summary": self._generate_summary()
         }
     
     def _summarize_entities(self) -> Dict[str, int]:
         """エンティティの統計"""
-        summary = {}
-        for entity in self.entities:
-            etype = entity["type"]
-            summary[etype] = summary.get(etype, 0) + 1
-        return summary
+        return dict(self._entity_counts)
     
     def _generate_summary(self) -> Dict[str, Any]:
         """図面の要約を生成"""
-        # 主要寸法を検出（最大値）
-        key_dimensions = []
-        if self.dimensions:
-            sorted_dims = sorted(
-                [d for d in self.dimensions if d.get("measurement")],
-                key=lambda x: x["measurement"],
-                reverse=True
-            )
-            key_dimensions = sorted_dims[:5]  # 上位5つ
+        # 主要寸法を検出（最大値の上位5つ。全件ソートせずヒープで選ぶ）
+        key_dimensions = heapq.nlargest(
+            5,
+            (d for d in self.dimensions if d.get("measurement")),
+            key=lambda x: x["measurement"]
+        )
         
-        # 材質情報
-        materials = [m["content"] for m in self.material_info]
+        # 材質情報（同じ注記の繰り返しは1つにまとめ、図面内の出現順を保つ）
+        materials = list(dict.fromkeys(m["content"] for m in self.material_info))
         
         return {
             "key_dimensions": key_dimensions,
             "materials": materials,
-            "total_entities": len(self.entities),
+            "total_entities": self.entities_count,
             "has_bom": len(self.tables) > 0,
             "annotation_count": len(self.annotations)
         }
 
 
+# エンティティタイプ → ハンドラ（EnhancedDXFParser._extract_all で使用）
+DISPATCH = {
+    'DIMENSION': EnhancedDXFParser._handle_dimension,
+    'TEXT': EnhancedDXFParser._handle_text,
+    'MTEXT': EnhancedDXFParser._handle_text,
+    'INSERT': EnhancedDXFParser._handle_insert,
+    **{etype: EnhancedDXFParser._handle_geometry for etype in ENTITY_GEOMETRY},
+}
+
+
+def parse_dxf_file(filepath: str) -> Dict[str, Any]:
+    """DXFファイルを解析して結果を返す（API のワーカープロセスから呼び出す）"""
+    return EnhancedDXFParser(Path(filepath)).parse()
+
+
+def dumps_json(data: Dict[str, Any], pretty: bool = False) -> bytes:
+    """解析結果を UTF-8 の JSON バイト列に変換（orjson があれば使用）"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else 0)
+    return json.dumps(data, ensure_ascii=False, indent=2 if pretty else None).encode('utf-8')
+
+
 def main():
     ap = argparse.ArgumentParser(description="拡張DXF解析エンジン")
     ap.add_argument("input", help="DXFファイル")
@@ -323,11 +459,10 @@ def main():
         if args.output:
             output_path = Path(args.output)
             output_path.parent.mkdir(parents=True, exist_ok=True)
-            with output_path.open('w', encoding='utf-8') as f:
-                json.dump(result, f, ensure_ascii=False, indent=2 if args.pretty else None)
+            output_path.write_bytes(dumps_json(result, args.pretty))
             print(f"✓ 出力: {output_path}")
         else:
-            print(json.dumps(result, ensure_ascii=False, indent=2 if args.pretty else None))
+            print(dumps_json(result, args.pretty).decode('utf-8'))
         
         # サマリー表示
         print(f"\n📊 解析結果:")
@@ -6,13 +6,17 @@
 """
 
 import argparse
+import asyncio
 import os
 import sys
-from typing import List, Dict, Any, Optional
-import time
+from typing import List, Dict, Any, Optional, Union
+
+import httpx
+import numpy as np
 
 try:
     from supabase import create_client, Client
+    from supabase.lib.client_options import ClientOptions
 except ImportError:
     print("ERROR: supabase is not installed. Please run: pip install supabase", file=sys.stderr)
     sys.exit(1)
@@ -23,6 +27,13 @@ except ImportError:
     print("ERROR: openai is not installed. Please run: pip install openai", file=sys.stderr)
     sys.exit(1)
 
+# h2 があれば HTTP/2 で1本の接続に多重化（任意: pip install httpx[http2]）
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+
 
 def get_supabase_client() -> Client:
     """Supabaseクライアントを取得"""
@@ -33,7 +44,19 @@ def get_supabase_client() -> Client:
         print("ERROR: SUPABASE_SERVICE_ROLE_KEY environment variable is not set.", file=sys.stderr)
         sys.exit(1)
     
-    return create_client(url, key)
+    # PostgREST への接続を使い回す（h2 があれば並行リクエストを HTTP/2 で1本の接続に多重化）
+    http_client = httpx.Client(
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+        timeout=httpx.Timeout(120.0)
+    )
+    try:
+        options = ClientOptions(httpx_client=http_client)
+    except TypeError:
+        # httpx_client を渡せない古い supabase-py では既定のクライアントを使う
+        http_client.close()
+        return create_client(url, key)
+    return create_client(url, key, options=options)
 
 
 def setup_openai():
@@ -48,6 +71,32 @@ def setup_openai():
     openai.api_key = api_key
 
 
+def uuid_key(uuid_str: str) -> int:
+    """UUID文字列を集合のキー用の64bit整数に変換（下位64bit）"""
+    return int(uuid_str.replace("-", ""), 16) & 0xFFFFFFFFFFFFFFFF
+
+
+def fetch_existing_keys(supabase: Client, column: str, kind: str) -> set:
+    """既存の埋め込みの ID を uuid_key の集合で取得（応答の行データはこの関数内で解放される）"""
+    result = supabase.table("embeddings").select(column).eq("kind", kind).execute()
+    return {uuid_key(row[column]) for row in result.data if row.get(column)}
+
+
+def encode_embedding(embedding: List[float], quantize: Optional[str] = None) -> Union[List[float], str]:
+    """保存用に埋め込みを変換（quantize="int8" なら行ごとのスケールで int8 に量子化）
+    
+    int8 の場合は整数の pgvector テキスト表現（"[12,-3,...]"）を返す。検索はコサイン距離で
+    行のスケールに依存しないためスケールは保存しない。JSON の浮動小数点より転送量が約1/5になる。
+    """
+    if quantize != "int8":
+        return embedding
+    v = np.asarray(embedding, dtype=np.float32)
+    peak = float(np.abs(v).max()) if v.size else 0.0
+    if peak > 0:
+        v = np.rint(v * (127.0 / peak))
+    return "[" + ",".join(map(str, v.astype(np.int8).tolist())) + "]"
+
+
 def create_entity_payload(entity: Dict[str, Any], filename: str) -> str:
     """エンティティからpayloadテキストを生成"""
     parts = []
@@ -123,27 +172,117 @@ def generate_embeddings_batch(texts: List[str], model: str = "text-embedding-3-l
         raise
 
 
-def process_entities(supabase: Client, batch_size: int = 50, limit: Optional[int] = None, skip_existing: bool = True):
+# 一時的なエラー（レート制限・接続エラー・5xx）時の再試行回数
+# （retry-after ヘッダーがなければ指数バックオフ。SDK 側の再試行は無効にしてここで一元管理する）
+MAX_API_RETRIES = 6
+
+
+async def generate_embeddings_batch_async(
+    client: "openai.AsyncOpenAI",
+    texts: List[str],
+    sem: asyncio.Semaphore,
+    model: str = "text-embedding-3-large"
+) -> List[List[float]]:
+    """OpenAI APIで埋め込みを非同期にバッチ生成（同時実行数は sem で制限）"""
+    async with sem:
+        for attempt in range(MAX_API_RETRIES):
+            try:
+                response = await client.embeddings.create(
+                    model=model,
+                    input=texts
+                )
+                return [item.embedding for item in response.data]
+            except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt == MAX_API_RETRIES - 1:
+                    raise
+                # APIConnectionError はレスポンスを持たない
+                response = getattr(e, "response", None)
+                retry_after = response.headers.get("retry-after") if response is not None else None
+                try:
+                    delay = float(retry_after)
+                except (TypeError, ValueError):
+                    delay = 2 ** attempt
+                print(f"  ⏳ {type(e).__name__}: {delay:.1f}秒後に再試行します", file=sys.stderr)
+                await asyncio.sleep(delay)
+
+
+async def embed_and_insert_batches(supabase: Client, batches: List[tuple], total: int, concurrency: int,
+                                   ignore_duplicates: bool = True, quantize: Optional[str] = None) -> List[Any]:
+    """全バッチの埋め込み生成と保存を並行実行し、バッチごとの保存件数（または例外）を返す
+    
+    保存は entity_id の一意インデックスに対する upsert。ignore_duplicates=True なら既存行を残し
+    （ON CONFLICT DO NOTHING）、False なら既存行を新しい埋め込みで上書きする。
+    """
+    client = openai.AsyncOpenAI(api_key=openai.api_key, max_retries=0)
+    sem = asyncio.Semaphore(concurrency)
+    processed = 0
+    
+    async def run(batch_no: int, payloads: List[str], records: List[Dict[str, Any]]) -> int:
+        nonlocal processed
+        # payloads は重複なし。同じ payload のレコードには同じ埋め込みを割り当てる
+        embeddings = await generate_embeddings_batch_async(client, payloads, sem)
+        by_payload = {p: encode_embedding(e, quantize) for p, e in zip(payloads, embeddings)}
+        for record in records:
+            record["embedding"] = by_payload[record["payload"]]
+        
+        # Supabaseクライアントは同期APIのため、イベントループを止めないようスレッドで実行
+        # （1リクエストの行数は payload 数までに抑える）
+        chunk = max(len(payloads), 1)
+        for i in range(0, len(records), chunk):
+            rows = records[i:i + chunk]
+            await asyncio.to_thread(lambda: supabase.table("embeddings").upsert(
+                rows, on_conflict="entity_id", ignore_duplicates=ignore_duplicates
+            ).execute())
+        
+        processed += len(records)
+        print(f"  ✓ バッチ {batch_no}: {len(records)}件の埋め込みを保存しました（進捗: {processed}/{total}）")
+        return len(records)
+    
+    try:
+        return await asyncio.gather(
+            *(run(n, payloads, records) for n, (payloads, records) in enumerate(batches, 1)),
+            return_exceptions=True
+        )
+    finally:
+        await client.close()
+
+
+def process_entities(supabase: Client, batch_size: int = 50, limit: Optional[int] = None, skip_existing: bool = True,
+                     concurrency: int = 8, quantize: Optional[str] = None):
     """エンティティの埋め込みを生成"""
     print("\n" + "="*60)
     print("📝 エンティティの埋め込みを生成")
     print("="*60)
     
-    # 既存の埋め込みをチェック
-    existing_entity_ids = set()
+    entities = None
     if skip_existing:
-        result = supabase.table("embeddings").select("entity_id").eq("kind", "entity").execute()
-        existing_entity_ids = {row["entity_id"] for row in result.data if row.get("entity_id")}
-        print(f"既存の埋め込み: {len(existing_entity_ids)}件（スキップします）")
-    
-    # エンティティを取得（drawingと結合）
-    query = supabase.table("entities").select("*, drawings!inner(filename)").order("created_at")
-    
-    if limit:
-        query = query.limit(limit)
+        # 埋め込み未生成のエンティティのみをDB側で絞り込んで取得
+        query = supabase.table("entities_without_embedding").select("*").order("created_at")
+        if limit:
+            query = query.limit(limit)
+        try:
+            entities = query.execute().data
+        except Exception as e:
+            # ビューが未作成の場合（migration_embeddings.sql 未適用）はクライアント側で除外する
+            print(f"⚠️  entities_without_embedding view unavailable, filtering locally: {e}", file=sys.stderr)
+    
+    if entities is None:
+        # エンティティを取得（drawingと結合）
+        query = supabase.table("entities").select("*, drawings!inner(filename)").order("created_at")
+        if limit:
+            query = query.limit(limit)
+        entities = query.execute().data
+        
+        if skip_existing:
+            # UUID文字列ではなく64bit整数で保持し、集合のメモリを抑える
+            existing_keys = fetch_existing_keys(supabase, "entity_id", "entity")
+            print(f"既存の埋め込み: {len(existing_keys)}件（スキップします）")
+            entities = [e for e in entities if uuid_key(e["id"]) not in existing_keys]
     
-    result = query.execute()
-    entities = result.data
+    # 結合した図面名をビューと同じ filename 列に揃える
+    for entity in entities:
+        if "drawings" in entity:
+            entity["filename"] = entity.pop("drawings")["filename"]
     
     print(f"対象エンティティ: {len(entities)}件")
     
@@ -151,73 +290,44 @@ def process_entities(supabase: Client, batch_size: int = 50, limit: Optional[int
         print("処理対象がありません")
         return 0
     
-    # バッチ処理
-    total_processed = 0
-    total_inserted = 0
+    # payloadごとにレコードをまとめる（同じ payload は1回だけ埋め込みを生成する）
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for entity in entities:
+        payload = create_entity_payload(entity, entity["filename"])
+        groups.setdefault(payload, []).append({
+            "drawing_id": entity["drawing_id"],
+            "entity_id": entity["id"],
+            "kind": "entity",
+            "payload": payload
+        })
+    print(f"ユニークな payload: {len(groups)}件")
+    
+    # 重複のない payload をバッチ単位に分ける
+    unique_payloads = list(groups)
+    batches = []
+    for i in range(0, len(unique_payloads), batch_size):
+        payloads = unique_payloads[i:i + batch_size]
+        records = [record for payload in payloads for record in groups[payload]]
+        batches.append((payloads, records))
+    
+    # 埋め込み生成とDB保存（最大 concurrency バッチを同時に実行）
+    print(f"\n📦 {len(batches)}バッチを最大{concurrency}並列で処理中...")
+    # 取得後に別プロセスが保存した分は upsert の競合解決で重複を防ぐ
+    results = asyncio.run(embed_and_insert_batches(supabase, batches, len(entities), concurrency,
+                                                   ignore_duplicates=skip_existing, quantize=quantize))
     
-    for i in range(0, len(entities), batch_size):
-        batch = entities[i:i + batch_size]
-        
-        # 既存をスキップ
-        if skip_existing:
-            batch = [e for e in batch if e["id"] not in existing_entity_ids]
-        
-        if not batch:
-            continue
-        
-        print(f"\n📦 バッチ {i//batch_size + 1}: {len(batch)}件を処理中...")
-        
-        # payloadを作成
-        payloads = []
-        metadata = []
-        
-        for entity in batch:
-            filename = entity["drawings"]["filename"]
-            payload = create_entity_payload(entity, filename)
-            payloads.append(payload)
-            metadata.append({
-                "drawing_id": entity["drawing_id"],
-                "entity_id": entity["id"],
-                "payload": payload
-            })
-        
-        # 埋め込み生成
-        try:
-            print("  → OpenAI APIで埋め込み生成中...")
-            embeddings = generate_embeddings_batch(payloads)
-            
-            # DBに挿入
-            print("  → Supabaseに保存中...")
-            records = []
-            for meta, embedding in zip(metadata, embeddings):
-                records.append({
-                    "drawing_id": meta["drawing_id"],
-                    "entity_id": meta["entity_id"],
-                    "kind": "entity",
-                    "payload": meta["payload"],
-                    "embedding": embedding
-                })
-            
-            supabase.table("embeddings").insert(records).execute()
-            
-            total_processed += len(batch)
-            total_inserted += len(records)
-            
-            print(f"  ✓ {len(records)}件の埋め込みを保存しました")
-            print(f"  進捗: {total_processed}/{len(entities)}")
-            
-            # レート制限対策
-            time.sleep(0.5)
-            
-        except Exception as e:
-            print(f"  ✗ エラー: {e}", file=sys.stderr)
-            continue
+    total_inserted = 0
+    for batch_no, result in enumerate(results, 1):
+        if isinstance(result, Exception):
+            print(f"  ✗ バッチ {batch_no} エラー: {result}", file=sys.stderr)
+        else:
+            total_inserted += result
     
     print(f"\n✨ 完了: {total_inserted}件の埋め込みを生成しました")
     return total_inserted
 
 
-def process_drawings(supabase: Client, skip_existing: bool = True):
+def process_drawings(supabase: Client, skip_existing: bool = True, quantize: Optional[str] = None):
     """図面の埋め込みを生成"""
     print("\n" + "="*60)
     print("📄 図面の埋め込みを生成")
@@ -226,8 +336,7 @@ def process_drawings(supabase: Client, skip_existing: bool = True):
     # 既存の埋め込みをチェック
     existing_drawing_ids = set()
     if skip_existing:
-        result = supabase.table("embeddings").select("drawing_id").eq("kind", "drawing").execute()
-        existing_drawing_ids = {row["drawing_id"] for row in result.data if row.get("drawing_id")}
+        existing_drawing_ids = fetch_existing_keys(supabase, "drawing_id", "drawing")
         print(f"既存の埋め込み: {len(existing_drawing_ids)}件（スキップします）")
     
     # 図面を取得
@@ -235,7 +344,7 @@ def process_drawings(supabase: Client, skip_existing: bool = True):
     drawings = result.data
     
     if skip_existing:
-        drawings = [d for d in drawings if d["id"] not in existing_drawing_ids]
+        drawings = [d for d in drawings if uuid_key(d["id"]) not in existing_drawing_ids]
     
     print(f"対象図面: {len(drawings)}件")
     
@@ -269,7 +378,7 @@ def process_drawings(supabase: Client, skip_existing: bool = True):
                 "entity_id": None,
                 "kind": "drawing",
                 "payload": meta["payload"],
-                "embedding": embedding
+                "embedding": encode_embedding(embedding, quantize)
             })
         
         supabase.table("embeddings").insert(records).execute()
@@ -290,6 +399,8 @@ def main():
     ap.add_argument("--batch-size", type=int, default=50, help="バッチサイズ（デフォルト: 50）")
     ap.add_argument("--limit", type=int, help="処理する最大件数（テスト用）")
     ap.add_argument("--force", action="store_true", help="既存の埋め込みをスキップしない")
+    ap.add_argument("--concurrency", type=int, default=8, help="同時に実行するバッチ数（デフォルト: 8）")
+    ap.add_argument("--quantize", choices=["int8"], help="埋め込みを量子化して送信（転送量を削減）")
     args = ap.parse_args()
     
     # 環境変数チェック
@@ -304,10 +415,11 @@ def main():
     total = 0
     
     if args.all or args.entities:
-        total += process_entities(supabase, args.batch_size, args.limit, skip_existing)
+        total += process_entities(supabase, args.batch_size, args.limit, skip_existing, args.concurrency,
+                                  args.quantize)
     
     if args.all or args.drawings:
-        total += process_drawings(supabase, skip_existing)
+        total += process_drawings(supabase, skip_existing, args.quantize)
     
     if not (args.entities or args.drawings or args.all):
         print("\nUsage:")
@@ -14,6 +14,8 @@ try:
 except Exception as e:
     raise SystemExit("Please install ezdxf: pip install ezdxf") from e
 
+import numpy as np
+
 MATERIALS = ["S45C", "SUS304", "A5052", "SKD11", "SCM435"]
 TOLERANCES = ["±0.01", "±0.02", "±0.05"]
 THREADS = ["M6", "M8", "M10", "M12"]
@@ -25,11 +27,11 @@ def make_layers(doc):
         if name not in doc.layers:
             doc.layers.add(name)
 
-def add_title_block(msp, filename, pos=(0, -40)):
+def add_title_block(msp, filename, date_long, pos=(0, -40)):
     x, y = pos
     msp.add_lwpolyline([(x, y), (x+180, y), (x+180, y+30), (x, y+30), (x, y)], dxfattribs={"layer": "Plan 1"})
     msp.add_text(f"{filename}", dxfattribs={"layer": "Text", "height": 3, "insert": (x+5, y+22)})
-    msp.add_text(f"DATE: {datetime.now().strftime('%Y-%m-%d')}", dxfattribs={"layer": "Text", "height": 2.5, "insert": (x+5, y+14)})
+    msp.add_text(f"DATE: {date_long}", dxfattribs={"layer": "Text", "height": 2.5, "insert": (x+5, y+14)})
     msp.add_text("DRAWN BY: AI-GEN", dxfattribs={"layer": "Text", "height": 2.5, "insert": (x+5, y+7)})
 
 def annotate_notes(msp, notes, origin=(100, 60)):
@@ -38,6 +40,80 @@ def annotate_notes(msp, notes, origin=(100, 60)):
     for i, note in enumerate(notes):
         msp.add_text(note, dxfattribs={"layer": "Text", "height": 3, "insert": (x, y - i*line_h)})
 
+def sleeve_base_pts(R):
+    pts = np.empty((4, 2))
+    pts[0, 0] = -R; pts[0, 1] = -R - 5
+    pts[1, 0] = -R; pts[1, 1] = -R - 8
+    pts[2, 0] = R;  pts[2, 1] = -R - 8
+    pts[3, 0] = R;  pts[3, 1] = -R - 5
+    return pts
+
+def bracket_pts(w, h):
+    pts = np.empty((5, 2))
+    pts[0, 0] = -w/2; pts[0, 1] = -h/2
+    pts[1, 0] = w/2;  pts[1, 1] = -h/2
+    pts[2, 0] = w/2;  pts[2, 1] = h/2
+    pts[3, 0] = -w/2; pts[3, 1] = h/2
+    pts[4, 0] = -w/2; pts[4, 1] = -h/2
+    return pts
+
+def cover_pts(w, h, r):
+    pts = np.empty((9, 2))
+    pts[0, 0] = -w/2+r; pts[0, 1] = -h/2
+    pts[1, 0] = w/2-r;  pts[1, 1] = -h/2
+    pts[2, 0] = w/2;    pts[2, 1] = -h/2+r
+    pts[3, 0] = w/2;    pts[3, 1] = h/2-r
+    pts[4, 0] = w/2-r;  pts[4, 1] = h/2
+    pts[5, 0] = -w/2+r; pts[5, 1] = h/2
+    pts[6, 0] = -w/2;   pts[6, 1] = h/2-r
+    pts[7, 0] = -w/2;   pts[7, 1] = -h/2+r
+    pts[8, 0] = -w/2+r; pts[8, 1] = -h/2
+    return pts
+
+def shaft_pts(L, d1, d2):
+    # upper profile left->right, then lower profile right->left, closed
+    xs = (-L/2, -L/4, -L/4, L/4, L/4, L/2)
+    ys = (d1/2, d1/2, d2/2, d2/2, d1/2, d1/2)
+    pts = np.empty((13, 2))
+    for i in range(6):
+        pts[i, 0] = xs[i]; pts[i, 1] = ys[i]
+        pts[11 - i, 0] = xs[i]; pts[11 - i, 1] = -ys[i]
+    pts[12, 0] = -L/2; pts[12, 1] = d1/2
+    return pts
+
+# Pure-Python outline kernels: the source for both --jit and the geom_numba AOT build
+OUTLINE_KERNELS = {
+    "sleeve_base_pts": sleeve_base_pts,
+    "bracket_pts": bracket_pts,
+    "cover_pts": cover_pts,
+    "shaft_pts": shaft_pts,
+}
+
+def use_kernels(kernels):
+    """Swap the module-level outline kernels used by the draw_* functions."""
+    global sleeve_base_pts, bracket_pts, cover_pts, shaft_pts
+    sleeve_base_pts = kernels["sleeve_base_pts"]
+    bracket_pts = kernels["bracket_pts"]
+    cover_pts = kernels["cover_pts"]
+    shaft_pts = kernels["shaft_pts"]
+
+def enable_jit():
+    """Replace the outline kernels with numba-compiled versions (--jit)."""
+    try:
+        from numba import njit
+    except ImportError as e:
+        raise SystemExit("Please install numba for --jit: pip install numba") from e
+    use_kernels({name: njit(cache=True)(fn) for name, fn in OUTLINE_KERNELS.items()})
+
+# Use the ahead-of-time compiled kernels when geom_aot has been built
+# (python geom_numba.py); no numba import or compile at run time.
+try:
+    import geom_aot
+except ImportError:
+    geom_aot = None
+if geom_aot is not None:
+    use_kernels({name: getattr(geom_aot, name) for name in OUTLINE_KERNELS})
+
 def draw_sleeve(msp, params):
     R = params["outer_d"]/2
     r = params["inner_d"]/2
@@ -45,12 +121,11 @@ def draw_sleeve(msp, params):
     msp.add_circle((0, 0), r, dxfattribs={"layer": "Plan 1"})
     msp.add_line((-R-10, 0), (R+10, 0), dxfattribs={"layer": "Dim"})
     msp.add_line((0, -R-10), (0, R+10), dxfattribs={"layer": "Dim"})
-    msp.add_lwpolyline([(-R, -R-5), (-R, -R-8), (R, -R-8), (R, -R-5)], dxfattribs={"layer": "Plan 1"})
+    msp.add_lwpolyline(sleeve_base_pts(R), dxfattribs={"layer": "Plan 1"})
 
 def draw_bracket(msp, params):
     w, h = params["width"], params["height"]
-    pts = [(-w/2, -h/2), (w/2, -h/2), (w/2, h/2), (-w/2, h/2), (-w/2, -h/2)]
-    msp.add_lwpolyline(pts, dxfattribs={"layer": "Plan 1"})
+    msp.add_lwpolyline(bracket_pts(float(w), float(h)), dxfattribs={"layer": "Plan 1"})
     for dx in (-w*0.3, w*0.3):
         for dy in (-h*0.3, h*0.3):
             msp.add_circle((dx, dy), params["hole_d"]/2, dxfattribs={"layer": "Plan 1"})
@@ -59,17 +134,12 @@ def draw_bracket(msp, params):
 def draw_cover(msp, params):
     w, h = params["width"], params["height"]
     r = min(w, h) * 0.15
-    pts = [(-w/2+r, -h/2), (w/2-r, -h/2), (w/2, -h/2+r),
-           (w/2, h/2-r), (w/2-r, h/2), (-w/2+r, h/2),
-           (-w/2, h/2-r), (-w/2, -h/2+r), (-w/2+r, -h/2)]
-    msp.add_lwpolyline(pts, dxfattribs={"layer": "Plan 1"})
+    msp.add_lwpolyline(cover_pts(float(w), float(h), r), dxfattribs={"layer": "Plan 1"})
     msp.add_circle((0, 0), params["center_hole_d"]/2, dxfattribs={"layer": "Plan 1"})
 
 def draw_shaft(msp, params):
     L = params["length"]; d1 = params["d1"]; d2 = params["d2"]
-    steps = [(-L/2, d1/2), (-L/4, d1/2), (-L/4, d2/2), (L/4, d2/2), (L/4, d1/2), (L/2, d1/2),
-             (L/2, -d1/2), (L/4, -d1/2), (L/4, -d2/2), (-L/4, -d2/2), (-L/4, -d1/2), (-L/2, -d1/2), (-L/2, d1/2)]
-    msp.add_lwpolyline(steps, dxfattribs={"layer": "Plan 1"})
+    msp.add_lwpolyline(shaft_pts(float(L), float(d1), float(d2)), dxfattribs={"layer": "Plan 1"})
 
 def random_params(ptype, rng):
     if ptype == "sleeve":
@@ -87,14 +157,15 @@ def random_params(ptype, rng):
         return {"length": rng.choice([80,100,120]), "d1": rng.choice([12,16,20]), "d2": rng.choice([8,10,12])}
     raise ValueError("unknown part type")
 
-def generate_one(out_dir: Path, idx: int, ptype: str, rng: random.Random) -> dict:
+def generate_one(out_dir: Path, idx: int, ptype: str, rng: random.Random,
+                 date_short: str, date_long: str) -> dict:
     params = random_params(ptype, rng)
     material = rng.choice(MATERIALS)
     tol = rng.choice(TOLERANCES)
     thread = rng.choice(THREADS)
     finish = rng.choice(FINISHES)
 
-    filename = f"{datetime.now().strftime('%y%m%d')}_{ptype}_{idx:03d}.dxf"
+    filename = f"{date_short}_{ptype}_{idx:03d}.dxf"
     path = out_dir / filename
 
     doc = ezdxf.new(setup=True)
@@ -135,11 +206,7 @@ def generate_one(out_dir: Path, idx: int, ptype: str, rng: random.Random) -> dic
     for i, note in enumerate(notes):
         msp.add_text(note, dxfattribs={"layer": "Text", "height": 3, "insert": (x0, y0 - i*4)})
     # title block
-    x, y = (0, -40)
-    msp.add_lwpolyline([(x, y), (x+180, y), (x+180, y+30), (x, y+30), (x, y)], dxfattribs={"layer": "Plan 1"})
-    msp.add_text(f"{filename}", dxfattribs={"layer": "Text", "height": 3, "insert": (x+5, y+22)})
-    msp.add_text(f"DATE: {datetime.now().strftime('%Y-%m-%d')}", dxfattribs={"layer": "Text", "height": 2.5, "insert": (x+5, y+14)})
-    msp.add_text("DRAWN BY: AI-GEN", dxfattribs={"layer": "Text", "height": 2.5, "insert": (x+5, y+7)})
+    add_title_block(msp, filename, date_long)
     # border
     msp.add_lwpolyline([(-150, -100), (150, -100), (150, 100), (-150, 100), (-150, -100)], dxfattribs={"layer": "0"})
 
@@ -162,17 +229,28 @@ def main():
     parser.add_argument("--count", type=int, default=30)
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--types", nargs="*", choices=PART_TYPES, default=PART_TYPES)
+    parser.add_argument("--jit", action="store_true",
+                        help="JIT-compile outline kernels with numba (numba import/compile costs ~0.5s; only for very large --count)")
     args = parser.parse_args()
 
+    if args.jit:
+        enable_jit()
+
     rng = random.Random(args.seed)
     out_dir = Path(args.out)
     out_dir.mkdir(parents=True, exist_ok=True)
 
+    # One timestamp for the whole run: file names and title blocks share the same date
+    now = datetime.now()
+    date_short = now.strftime('%y%m%d')
+    date_long = now.strftime('%Y-%m-%d')
+
     manifest = out_dir / "manifest.jsonl"
-    with manifest.open("w", encoding="utf-8") as f:
+    # Lines are small (~200 bytes); a 1 MiB buffer keeps even --count 10000 to a couple of writes
+    with manifest.open("w", encoding="utf-8", buffering=1 << 20) as f:
         for i in range(1, args.count + 1):
             ptype = args.types[(i-1) % len(args.types)]
-            rec = generate_one(out_dir, i, ptype, rng)
+            rec = generate_one(out_dir, i, ptype, rng, date_short, date_long)
             f.write(json.dumps(rec, ensure_ascii=False) + "\n")
 
     print(f"Generated {args.count} DXFs in {out_dir}")
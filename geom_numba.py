@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+geom_numba.py - ahead-of-time build of the mock outline kernels.
+
+Run once at build time:
+    python geom_numba.py
+This writes the geom_aot extension module next to this file.
+generate_mock_dxfs.py imports it automatically when it exists, so
+generation starts without importing numba or paying JIT compile time.
+"""
+try:
+    from numba.pycc import CC
+except Exception as e:
+    raise SystemExit("Please install numba: pip install numba") from e
+
+from generate_mock_dxfs import OUTLINE_KERNELS
+
+cc = CC("geom_aot")
+cc.export("sleeve_base_pts", "f8[:,:](f8)")(OUTLINE_KERNELS["sleeve_base_pts"])
+cc.export("bracket_pts", "f8[:,:](f8, f8)")(OUTLINE_KERNELS["bracket_pts"])
+cc.export("cover_pts", "f8[:,:](f8, f8, f8)")(OUTLINE_KERNELS["cover_pts"])
+cc.export("shaft_pts", "f8[:,:](f8, f8, f8)")(OUTLINE_KERNELS["shaft_pts"])
+
+if __name__ == "__main__":
+    cc.compile()
+    print(f"Built {cc.output_file} in {cc.output_dir}")
@@ -6,18 +6,54 @@ Supabase Python Clientを使用してデータを投入
 """
 
 import argparse
-import json
 import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count as count_from, islice
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
 import os
 
+import httpx
+
 try:
     from supabase import create_client, Client
+    from supabase.lib.client_options import ClientOptions
 except ImportError:
     print("ERROR: supabase is not installed. Please run: pip install supabase", file=sys.stderr)
     sys.exit(1)
 
+try:
+    import orjson
+except ImportError:
+    print("ERROR: orjson is not installed. Please run: pip install orjson", file=sys.stderr)
+    sys.exit(1)
+
+# ijson があれば entities をストリーミングで読み、ファイル全体をメモリに載せない（任意）
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# h2 があれば HTTP/2 で1本の接続に多重化（任意: pip install httpx[http2]）
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+
+
+# entities の1リクエストあたりの行数
+DEFAULT_BATCH_SIZE = 5000
+# 同時に送るバッチ数（スレッド数）と、同時に処理するファイル数の上限
+DEFAULT_WORKERS = 8
+MAX_FILE_WORKERS = 4
+# 1ファイルあたり送信待ちにしておくバッチ数の上限
+MAX_PENDING_BATCHES = 16
+# 429（レート制限）時の最大再試行回数
+MAX_RETRIES = 5
+
 
 def get_supabase_client() -> Client:
     """Supabaseクライアントを取得"""
@@ -29,7 +65,31 @@ def get_supabase_client() -> Client:
         print("Example: export SUPABASE_SERVICE_ROLE_KEY='eyJ...'", file=sys.stderr)
         sys.exit(1)
     
-    return create_client(url, key)
+    # PostgREST への接続を使い回す（h2 があれば並行リクエストを HTTP/2 で1本の接続に多重化）
+    http_client = httpx.Client(
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+        timeout=httpx.Timeout(120.0)
+    )
+    try:
+        options = ClientOptions(httpx_client=http_client)
+    except TypeError:
+        # httpx_client を渡せない古い supabase-py では既定のクライアントを使う
+        http_client.close()
+        return create_client(url, key)
+    return create_client(url, key, options=options)
+
+
+def execute_with_retry(query, retries: int = MAX_RETRIES):
+    """クエリを実行（429 の場合は指数バックオフで再試行）"""
+    for attempt in range(retries + 1):
+        try:
+            return query.execute()
+        except Exception as e:
+            # JSONでない 429 応答は postgrest の APIError.code に HTTP ステータスが入る
+            if getattr(e, "code", None) not in (429, "429") or attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
 
 
 def insert_drawing(supabase: Client, json_data: Dict[str, Any]) -> str:
@@ -46,7 +106,7 @@ def insert_drawing(supabase: Client, json_data: Dict[str, Any]) -> str:
         "entity_counts": meta.get("entity_counts", {})
     }
     
-    result = supabase.table("drawings").insert(drawing_data).execute()
+    result = execute_with_retry(supabase.table("drawings").insert(drawing_data))
     
     if not result.data or len(result.data) == 0:
         raise Exception("Failed to insert drawing")
@@ -54,84 +114,114 @@ def insert_drawing(supabase: Client, json_data: Dict[str, Any]) -> str:
     return result.data[0]["id"]
 
 
-def prepare_entity_data(drawing_id: str, entity: Dict[str, Any]) -> Dict[str, Any]:
-    """エンティティデータをSupabase用に整形"""
-    return {
-        "drawing_id": drawing_id,
-        "type": entity.get("type"),
-        "layer": entity.get("layer"),
-        "color": entity.get("color"),
-        "linetype": entity.get("linetype"),
-        "lineweight": entity.get("lineweight"),
-        "bbox": entity.get("bbox"),
-        "start": entity.get("start"),
-        "end": entity.get("end"),
-        "center": entity.get("center"),
-        "radius": entity.get("radius"),
-        "start_angle": entity.get("start_angle"),
-        "end_angle": entity.get("end_angle"),
-        "points": entity.get("points"),
-        "is_closed": entity.get("is_closed"),
-        "fit_points": entity.get("fit_points"),
-        "major_axis": entity.get("major_axis"),
-        "ratio": entity.get("ratio"),
-        "text": entity.get("text"),
-        "position": entity.get("position"),
-        "name": entity.get("name"),
-        "insert": entity.get("insert"),
-        "xscale": entity.get("xscale"),
-        "yscale": entity.get("yscale"),
-        "rotation": entity.get("rotation"),
-        "measurement": entity.get("measurement"),
-        "solid_fill": entity.get("solid_fill"),
-        "pattern_name": entity.get("pattern_name"),
-    }
+# entities テーブルの列（drawing_id 以外は JSON のキーと同名）
+ENTITY_COLUMNS = (
+    "type", "layer", "color", "linetype", "lineweight", "bbox",
+    "start", "end", "center", "radius", "start_angle", "end_angle",
+    "points", "is_closed", "fit_points", "major_axis", "ratio",
+    "text", "position", "name", "insert", "xscale", "yscale", "rotation",
+    "measurement", "solid_fill", "pattern_name",
+)
+
+
+def build_prepare_entity_data():
+    """列構成に特化した prepare_entity_data を生成する（列ループを辞書リテラル1つに展開）"""
+    items = ", ".join(f"{column!r}: get({column!r})" for column in ENTITY_COLUMNS)
+    source = (
+        "def prepare_entity_data(drawing_id, entity):\n"
+        "    get = entity.get\n"
+        f"    return {{'drawing_id': drawing_id, {items}}}\n"
+    )
+    namespace = {}
+    exec(source, namespace)
+    return namespace["prepare_entity_data"]
+
+
+# エンティティデータをSupabase用に整形: prepare_entity_data(drawing_id, entity) -> dict
+prepare_entity_data = build_prepare_entity_data()
+
 
+def insert_entities_batch(supabase: Client, drawing_id: str, entities: Iterable[Dict[str, Any]],
+                          batch_size: int = DEFAULT_BATCH_SIZE, executor: Optional[ThreadPoolExecutor] = None) -> int:
+    """entitiesテーブルに複数レコードをバッチ挿入し、挿入件数を返す（executor があればバッチを並行送信）"""
+    # 1リクエストのオーバーヘッドが支配的なので大きめのバッチで送る
+    # （リクエストサイズの上限に当たる場合は --batch-size で小さくする）
+    def send(batch_no: int, data: List[Dict[str, Any]]):
+        # 挿入した行を返させない（応答で同じデータを受け取り直さない）。失敗時は例外になる
+        execute_with_retry(supabase.table("entities").insert(data, returning="minimal"))
+        
+        print(f"  ✓ Inserted {len(data)} entities (batch {batch_no})")
+    
+    # entities はイテレータでもよい（読み込みながらバッチを作って送る）
+    entities = iter(entities)
+    count = 0
+    pending = deque()
+    for batch_no in count_from(1):
+        data = [prepare_entity_data(drawing_id, e) for e in islice(entities, batch_size)]
+        if not data:
+            break
+        count += len(data)
+        if executor is None:
+            send(batch_no, data)
+        else:
+            # HTTP待ちが中心なのでスレッドで並行に送る。未完了のバッチ数を抑えてメモリを一定に保つ
+            pending.append(executor.submit(send, batch_no, data))
+            if len(pending) >= MAX_PENDING_BATCHES:
+                pending.popleft().result()
+    # 失敗したバッチの例外はここで再送出
+    for future in pending:
+        future.result()
+    return count
 
-def insert_entities_batch(supabase: Client, drawing_id: str, entities: List[Dict[str, Any]]):
-    """entitiesテーブルに複数レコードをバッチ挿入"""
-    if not entities:
-        return
+
+def load_json_file(json_path: Path) -> Tuple[Dict[str, Any], Iterator[Dict[str, Any]]]:
+    """JSONファイルの meta と entities のイテレータを返す（ijson があればストリーミング）"""
+    if ijson is None:
+        data = orjson.loads(json_path.read_bytes())
+        return data.get("meta", {}), iter(data.get("entities", []))
     
-    # Supabaseは一度に大量のデータを送ると失敗する可能性があるので、
-    # バッチサイズを制限
-    batch_size = 100
+    # dxf_to_json.py の出力は meta が先頭にあるので、meta の読み取りはすぐ終わる
+    with json_path.open("rb") as f:
+        meta = next(ijson.items(f, "meta", use_float=True), {})
     
-    for i in range(0, len(entities), batch_size):
-        batch = entities[i:i + batch_size]
-        data = [prepare_entity_data(drawing_id, e) for e in batch]
-        
-        result = supabase.table("entities").insert(data).execute()
-        
-        if not result.data:
-            raise Exception(f"Failed to insert entities batch {i//batch_size + 1}")
-        
-        print(f"  ✓ Inserted {len(data)} entities (batch {i//batch_size + 1})")
+    def iter_entities():
+        with json_path.open("rb") as f:
+            yield from ijson.items(f, "entities.item", use_float=True)
+    
+    return meta, iter_entities()
+
 
+def count_entities(json_path: Path) -> int:
+    """エンティティ数を返す（meta の entity_sampled があれば本体は読まない）"""
+    meta, entities = load_json_file(json_path)
+    if "entity_sampled" in meta:
+        return meta["entity_sampled"]
+    # meta に件数がない場合は entities を1件ずつ数える（ijson があれば定数メモリ）
+    return sum(1 for _ in entities)
 
-def import_json_file(supabase: Client, json_path: Path) -> Dict[str, Any]:
+
+def import_json_file(supabase: Client, json_path: Path, batch_size: int = DEFAULT_BATCH_SIZE,
+                     executor: Optional[ThreadPoolExecutor] = None) -> Dict[str, Any]:
     """1つのJSONファイルをSupabaseにインポート"""
     try:
-        with json_path.open("r", encoding="utf-8") as f:
-            data = json.load(f)
+        meta, entities = load_json_file(json_path)
         
         print(f"\n📄 Processing: {json_path.name}")
         
         # drawingsテーブルに挿入
         print("  → Inserting drawing metadata...")
-        drawing_id = insert_drawing(supabase, data)
+        drawing_id = insert_drawing(supabase, {"meta": meta})
         print(f"  ✓ Drawing ID: {drawing_id}")
         
-        # entitiesテーブルに一括挿入
-        entities = data.get("entities", [])
-        print(f"  → Inserting {len(entities)} entities...")
-        insert_entities_batch(supabase, drawing_id, entities)
+        # entitiesテーブルに一括挿入（読みながらバッチ単位で送る）
+        print(f"  → Inserting {meta.get('entity_sampled', 0)} entities...")
+        entity_count = insert_entities_batch(supabase, drawing_id, entities, batch_size, executor)
         
         return {
             "file": str(json_path),
             "ok": True,
             "drawing_id": drawing_id,
-            "entity_count": len(entities)
+            "entity_count": entity_count
         }
     except Exception as e:
         return {
@@ -159,6 +249,12 @@ def main():
     ap.add_argument("--url", help="Supabase URL (省略時は環境変数 SUPABASE_URL を使用)")
     ap.add_argument("--key", help="Supabase Service Role Key (省略時は環境変数 SUPABASE_SERVICE_ROLE_KEY を使用)")
     ap.add_argument("--dry-run", action="store_true", help="実際には挿入せず、処理内容のみ表示")
+    ap.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                    help=f"entities の1リクエストあたりの行数（デフォルト: {DEFAULT_BATCH_SIZE}）")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                    help=f"同時に送信するバッチ数（デフォルト: {DEFAULT_WORKERS}）")
+    ap.add_argument("--use-copy", action="store_true",
+                    help="PostgreSQLに直接接続し COPY で一括投入（環境変数 SUPABASE_DB_URL を使用、psycopg2 が必要）")
     args = ap.parse_args()
     
     src = Path(args.input)
@@ -170,37 +266,53 @@ def main():
         os.environ["SUPABASE_SERVICE_ROLE_KEY"] = args.key
     
     # Supabaseクライアント
+    conn = None
     if args.dry_run:
         print("[DRY RUN MODE] Supabaseには接続しません")
         supabase = None
+    elif args.use_copy:
+        # PostgRESTのバッチPOSTではなく、json_to_db.py の COPY 経路で投入する
+        import json_to_db
+        conn = json_to_db.get_db_connection(os.getenv("SUPABASE_DB_URL"))
+        supabase = None
+        print("✓ データベースに直接接続しました（COPYモード）")
     else:
         supabase = get_supabase_client()
         print("✓ Supabaseに接続しました")
     
     # JSONファイルを処理
-    found = False
+    json_files = list(iter_json_files(src))
+    if not json_files:
+        print("No JSON files found.", file=sys.stderr)
+        sys.exit(1)
+    
     results = []
     
-    for json_path in iter_json_files(src):
-        found = True
-        
-        if args.dry_run:
+    def report(json_path: Path, result: Dict[str, Any]):
+        results.append(result)
+        status = "✓" if result.get("ok") else "✗"
+        print(f"\n[{status}] {json_path.name}")
+        if not result.get("ok"):
+            print(f"    Error: {result.get('error')}")
+    
+    if args.dry_run:
+        for json_path in json_files:
             print(f"\n[DRY RUN] {json_path}")
-            with json_path.open("r", encoding="utf-8") as f:
-                data = json.load(f)
-            print(f"  - Entities: {len(data.get('entities', []))}")
+            print(f"  - Entities: {count_entities(json_path)}")
             results.append({"file": str(json_path), "ok": True, "dry_run": True})
-        else:
-            result = import_json_file(supabase, json_path)
-            results.append(result)
-            status = "✓" if result.get("ok") else "✗"
-            print(f"\n[{status}] {json_path.name}")
-            if not result.get("ok"):
-                print(f"    Error: {result.get('error')}")
-    
-    if not found:
-        print("No JSON files found.", file=sys.stderr)
-        sys.exit(1)
+    elif conn is not None:
+        for json_path in json_files:
+            print(f"\n📄 Processing: {json_path.name}")
+            report(json_path, json_to_db.import_json_file(conn, json_path))
+    else:
+        # ファイル単位とバッチ単位の両方で並行実行（同時リクエスト数はバッチ側のスレッド数で制限）
+        with ThreadPoolExecutor(max_workers=args.workers) as batch_pool, \
+                ThreadPoolExecutor(max_workers=min(args.workers, MAX_FILE_WORKERS)) as file_pool:
+            imported = file_pool.map(
+                lambda p: import_json_file(supabase, p, args.batch_size, batch_pool), json_files
+            )
+            for json_path, result in zip(json_files, imported):
+                report(json_path, result)
     
     # サマリー
     success_count = sum(1 for r in results if r.get("ok"))
@@ -209,6 +321,9 @@ def main():
     print(f"\n{'='*50}")
     print(f"✨ 完了: {success_count}件成功, {fail_count}件失敗")
     print(f"{'='*50}")
+    
+    if conn:
+        conn.close()
 
 
 if __name__ == "__main__":
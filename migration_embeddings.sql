@@ -18,13 +18,30 @@ CREATE TABLE IF NOT EXISTS embeddings (
 );
 
 -- インデックス（検索高速化）
--- 注意: HNSWインデックスは大量データがある場合のみ作成推奨
--- 少量データの場合は不要（スキャンの方が速い）
--- CREATE INDEX IF NOT EXISTS idx_embeddings_vector 
---   ON embeddings USING hnsw (embedding vector_cosine_ops);
+-- 注意: pgvector の HNSW は vector 型で2000次元までしか対応しないため、
+-- 3072次元は halfvec にキャストした式インデックスを作成する（pgvector 0.7.0 以降）
+CREATE INDEX IF NOT EXISTS idx_embeddings_vector
+  ON embeddings USING hnsw ((embedding::halfvec(3072)) halfvec_cosine_ops);
 
 CREATE INDEX IF NOT EXISTS idx_embeddings_drawing_id ON embeddings (drawing_id);
-CREATE INDEX IF NOT EXISTS idx_embeddings_entity_id ON embeddings (entity_id);
+-- entity_id は一意（generate_embeddings.py は ON CONFLICT (entity_id) で重複を防ぐ）
+-- 図面の埋め込みは entity_id が NULL なので制約の対象外
+-- 一意インデックスがまだない場合のみ、既存の重複を削除する（最新の埋め込み = MAX(id) を残す）
+DO $$
+DECLARE
+  deleted_count BIGINT;
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'ux_embeddings_entity_id') THEN
+    DELETE FROM embeddings a
+      USING embeddings b
+      WHERE a.entity_id = b.entity_id AND a.id < b.id;
+    GET DIAGNOSTICS deleted_count = ROW_COUNT;
+    RAISE NOTICE 'embeddings: 重複した entity_id の行を % 件削除しました', deleted_count;
+  END IF;
+END
+$$;
+DROP INDEX IF EXISTS idx_embeddings_entity_id;
+CREATE UNIQUE INDEX IF NOT EXISTS ux_embeddings_entity_id ON embeddings (entity_id);
 CREATE INDEX IF NOT EXISTS idx_embeddings_kind ON embeddings (kind);
 
 -- コメント
@@ -42,3 +59,108 @@ SELECT
     COUNT(DISTINCT entity_id) as unique_entities
 FROM embeddings
 GROUP BY kind;
+
+-- ========================================
+-- 意味検索用RPC（api.py から呼び出し）
+-- 上位 match_count 件のみを返すため、埋め込みをクライアントに転送しない
+-- 図面名・エンティティ情報も結合して返し、追加の問い合わせを不要にする
+-- ========================================
+-- 戻り値の列が変わった場合に備えて再作成する
+DROP FUNCTION IF EXISTS search_embeddings(vector, INT);
+
+CREATE FUNCTION search_embeddings(
+  query_embedding vector(3072),
+  match_count INT DEFAULT 20
+)
+RETURNS TABLE (
+  id BIGINT,
+  drawing_id UUID,
+  entity_id UUID,
+  kind TEXT,
+  payload TEXT,
+  score FLOAT,
+  filename TEXT,
+  entity_type TEXT,
+  layer TEXT,
+  text TEXT
+)
+LANGUAGE sql STABLE
+AS $$
+  SELECT
+    top.id,
+    top.drawing_id,
+    top.entity_id,
+    top.kind,
+    top.payload,
+    top.score,
+    d.filename,
+    en.type AS entity_type,
+    en.layer,
+    en.text
+  FROM (
+    SELECT
+      e.id,
+      e.drawing_id,
+      e.entity_id,
+      e.kind,
+      e.payload,
+      1 - (e.embedding <=> query_embedding) AS score,
+      -- idx_embeddings_vector を使うため、インデックスと同じ式で並べ替える
+      e.embedding::halfvec(3072) <=> query_embedding::halfvec(3072) AS distance
+    FROM embeddings e
+    ORDER BY distance
+    LIMIT match_count
+  ) top
+  LEFT JOIN drawings d ON d.id = top.drawing_id
+  LEFT JOIN entities en ON en.id = top.entity_id
+  ORDER BY top.distance;
+$$;
+
+-- ========================================
+-- ヘルスチェック用の件数取得RPC（api.py の /health から呼び出し）
+-- 3テーブルの件数を1往復で返す
+-- ========================================
+CREATE OR REPLACE FUNCTION get_counts()
+RETURNS TABLE (
+  embeddings BIGINT,
+  drawings BIGINT,
+  entities BIGINT
+)
+LANGUAGE sql STABLE
+AS $$
+  SELECT
+    (SELECT count(*) FROM embeddings),
+    (SELECT count(*) FROM drawings),
+    (SELECT count(*) FROM entities);
+$$;
+
+-- ========================================
+-- 埋め込みの float32 バイナリ表現（api.py のフォールバック検索・search_ui.py のローカル検索用）
+-- JSONの浮動小数点テキストではなく vector_send のバイト列を base64 で返す
+-- ========================================
+CREATE OR REPLACE VIEW embeddings_f32 AS
+SELECT
+    id,
+    drawing_id,
+    entity_id,
+    kind,
+    payload,
+    encode(vector_send(embedding), 'base64') AS embedding_f32
+FROM embeddings;
+
+-- ========================================
+-- 埋め込み未生成のエンティティ（generate_embeddings.py 用）
+-- 既存の埋め込みとの突き合わせをDB側で行い、未処理の行だけを返す
+-- ========================================
+CREATE OR REPLACE VIEW entities_without_embedding AS
+SELECT
+    e.*,
+    d.filename
+FROM entities e
+JOIN drawings d ON d.id = e.drawing_id
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM embeddings em
+    WHERE em.entity_id = e.id
+      AND em.kind = 'entity'
+);
@@ -6,12 +6,25 @@ Drawing Search UI - Streamlit アプリ
 
 import streamlit as st
 import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import os
+import base64
 import openai
 from supabase import create_client
+from supabase.lib.client_options import ClientOptions
+import httpx
+import orjson
 import numpy as np
-import json
-from typing import List, Dict, Any
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Tuple
+
+# h2 があれば HTTP/2 で1本の接続に多重化（任意: pip install httpx[http2]）
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
 
 # ページ設定
 st.set_page_config(
@@ -31,7 +44,25 @@ if not SUPABASE_KEY or not OPENAI_API_KEY:
     st.stop()
 
 openai.api_key = OPENAI_API_KEY
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+@st.cache_resource(show_spinner=False)
+def get_supabase():
+    """Supabaseクライアントを生成（再実行やセッションをまたいで1つを使い回す）"""
+    # PostgREST への接続も使い回し、プレビュー等の並行取得を HTTP/2 で1本の接続に多重化
+    http_client = httpx.Client(
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+        timeout=httpx.Timeout(120.0)
+    )
+    try:
+        options = ClientOptions(httpx_client=http_client)
+    except TypeError:
+        # httpx_client を渡せない古い supabase-py では既定のクライアントを使う
+        http_client.close()
+        return create_client(SUPABASE_URL, SUPABASE_KEY)
+    return create_client(SUPABASE_URL, SUPABASE_KEY, options=options)
+
+supabase = get_supabase()
 
 # スタイル
 st.markdown("""
@@ -87,53 +118,145 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-def embed_query(query: str) -> List[float]:
-    """クエリをベクトル化"""
+# 図面単位の重複除去のため、RPC で limit の何倍のヒットを取得するか
+SEARCH_OVERFETCH = 10
+# 埋め込みモデルとその次元数、ローカル検索用の埋め込み行列のキャッシュ期間（秒）
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIM = 3072
+EMBEDDING_MATRIX_TTL = 600
+# 図面・エンティティ詳細のキャッシュ期間（秒）
+DETAILS_CACHE_TTL = 300
+# ビューアーが描画するエンティティタイプと、描画に使うフィールド
+VIEWER_FIELDS = {
+    "CIRCLE": ("center", "radius"),
+    "LINE": ("start", "end"),
+    "LWPOLYLINE": ("points", "is_closed"),
+}
+# プレビュー用に取得する entities の列
+VIEWER_COLUMNS = ",".join(["drawing_id", "type"] + sorted({f for fields in VIEWER_FIELDS.values() for f in fields}))
+# CLIENT_SIDE_SEARCH=1 の場合、RPC を使わず全埋め込みを取得してローカルで検索する（デバッグ用）
+CLIENT_SIDE_SEARCH = os.getenv("CLIENT_SIDE_SEARCH", "").lower() in ("1", "true", "yes")
+# EMBEDDING_QUANTIZE=int8 の場合、ローカル検索用の行列を行ごとのスケール付き int8 で保持する（api.py と同じ）
+EMBEDDING_QUANTIZE = os.getenv("EMBEDDING_QUANTIZE", "").lower()
+INT8_BLOCK_ROWS = 4096
+
+@st.cache_data(persist="disk", max_entries=4096, show_spinner=False)
+def embed_text(model: str, text: str) -> List[float]:
+    """テキストをベクトル化（(モデル, テキスト) 単位でディスクにキャッシュし、再起動後も再利用）"""
     response = openai.embeddings.create(
-        model="text-embedding-3-large",
-        input=query
+        model=model,
+        input=text
     )
     return response.data[0].embedding
 
-def search_drawings(query_embedding: List[float], limit: int = 10) -> List[Dict[str, Any]]:
-    """ベクトル検索を実行"""
-    # 全埋め込みを取得して類似度計算（シンプル版）
-    all_embeddings = supabase.table("embeddings").select(
-        "id, drawing_id, entity_id, kind, payload, embedding"
-    ).execute()
+def embed_query(query: str) -> List[float]:
+    """クエリをベクトル化（空白を正規化してキャッシュを引く）"""
+    return embed_text(EMBEDDING_MODEL, " ".join(query.split()))
+
+def fetch_all_rows(table: str, columns: str, page_size: int = 1000,
+                   in_filters: Tuple[tuple, ...] = ()) -> List[dict]:
+    """PostgRESTの最大行数制限を超えてテーブル全体（in_filters=((列名, 値リスト), ...) 指定時はその行）をページングで取得"""
+    rows = []
+    while True:
+        query = supabase.table(table).select(columns)
+        for column, values in in_filters:
+            query = query.in_(column, values)
+        page = query.order("id").range(
+            len(rows), len(rows) + page_size - 1
+        ).execute().data
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+
+def decode_f32_embedding(value: str) -> np.ndarray:
+    """embeddings_f32 ビューの base64 (pgvector バイナリ形式) を float32 配列に変換"""
+    # vector_send の形式: int16 次元数 + int16 予約 + float4 (ビッグエンディアン) × 次元数
+    return np.frombuffer(base64.b64decode(value), dtype=">f4", offset=4).astype(np.float32)
+
+@st.cache_resource(ttl=EMBEDDING_MATRIX_TTL, show_spinner=False)
+def load_embedding_matrix() -> Dict[str, Any]:
+    """全埋め込みを L2 正規化済みの行列として読み込む（セッション間でキャッシュ）"""
+    try:
+        # float32 のバイト列で受け取る（JSONの浮動小数点テキストを解析しない）
+        rows = fetch_all_rows("embeddings_f32", "id, drawing_id, entity_id, kind, payload, embedding_f32")
+        vectors = [decode_f32_embedding(r.pop("embedding_f32")) for r in rows]
+    except Exception:
+        rows = fetch_all_rows("embeddings", "id, drawing_id, entity_id, kind, payload, embedding")
+        vectors = [orjson.loads(e) if isinstance(e, str) else e for e in (r.pop("embedding") for r in rows)]
     
-    results = []
-    query_vec = np.array(query_embedding, dtype=np.float64)
+    # 次元数が異なる行は除外
+    keep = [i for i, v in enumerate(vectors) if len(v) == EMBEDDING_DIM]
+    matrix = np.empty((len(keep), EMBEDDING_DIM), dtype=np.float32)
+    for row, i in enumerate(keep):
+        matrix[row] = vectors[i]
+    del vectors
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
     
-    for item in all_embeddings.data:
-        # embeddingがリストか文字列かをチェック
-        emb = item["embedding"]
-        if isinstance(emb, str):
-            import json
-            emb = json.loads(emb)
-        
-        emb_vec = np.array(emb, dtype=np.float64)
-        
-        # ベクトルの長さが一致するか確認
-        if len(query_vec) != len(emb_vec):
-            continue
-        
-        # コサイン類似度
-        similarity = np.dot(query_vec, emb_vec) / (
-            np.linalg.norm(query_vec) * np.linalg.norm(emb_vec)
-        )
-        
-        results.append({
+    scales = None
+    if EMBEDDING_QUANTIZE == "int8":
+        # 行ごとのスケールで int8 に量子化（行 ≈ q * scale、メモリ1/4）
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        matrix = np.rint(matrix / scales[:, None]).astype(np.int8)
+    return {"matrix": matrix, "scales": scales, "meta": [rows[i] for i in keep]}
+
+def local_search(query_embedding: List[float], match_count: int) -> List[Dict[str, Any]]:
+    """メモリ上の埋め込み行列で上位 match_count 件を検索（CLIENT_SIDE_SEARCH 用）"""
+    cache = load_embedding_matrix()
+    matrix, scales, meta = cache["matrix"], cache["scales"], cache["meta"]
+    query_vec = np.asarray(query_embedding, dtype=np.float32)
+    if not meta or query_vec.shape[0] != EMBEDDING_DIM:
+        return []
+    query_vec /= np.linalg.norm(query_vec) or 1.0
+    
+    # 正規化済みなので内積 = コサイン類似度（行列ベクトル積で全行を一度に計算）
+    if scales is None:
+        scores = matrix @ query_vec
+    else:
+        # int8 はブロックごとに float32 に戻して BLAS で計算し、最後にスケールを掛ける
+        scores = np.empty(len(meta), dtype=np.float32)
+        for start in range(0, len(meta), INT8_BLOCK_ROWS):
+            block = matrix[start:start + INT8_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query_vec
+        scores *= scales
+    k = min(match_count, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [{**meta[i], "score": float(scores[i])} for i in top]
+
+def search_drawings(query_embedding: List[float], limit: int = 10) -> List[Dict[str, Any]]:
+    """ベクトル検索を実行（pgvector の search_embeddings RPC で上位のみ取得）"""
+    # 同じ図面のヒットは1件にまとめるので、図面数 limit を満たせるよう多めに取得する
+    match_count = limit * SEARCH_OVERFETCH
+    if CLIENT_SIDE_SEARCH:
+        # デバッグ用: 全埋め込みを取得してローカルで計算
+        hits = local_search(query_embedding, match_count)
+    else:
+        try:
+            hits = supabase.rpc("search_embeddings", {
+                "query_embedding": query_embedding,
+                "match_count": match_count
+            }).execute().data
+        except Exception as e:
+            # 埋め込み全件の転送は暗黙には行わない
+            st.error(f"search_embeddings RPC の呼び出しに失敗しました: {e}\n\n"
+                     "migration_embeddings.sql を適用するか、CLIENT_SIDE_SEARCH=1 でローカル検索を有効にしてください。")
+            return []
+    
+    # スコア順に並んでいる
+    results = [
+        {
             "drawing_id": item["drawing_id"],
             "entity_id": item["entity_id"],
             "kind": item["kind"],
             "payload": item["payload"],
-            "score": float(similarity),
+            "score": float(item["score"]),
             "embedding_id": item["id"]
-        })
-    
-    # スコア順にソート
-    results.sort(key=lambda x: x["score"], reverse=True)
+        }
+        for item in hits
+    ]
     
     # 重複を除去（同じdrawing_idは最高スコアのものだけ残す）
     seen_drawings = set()
@@ -149,26 +272,75 @@ def search_drawings(query_embedding: List[float], limit: int = 10) -> List[Dict[
     
     return unique_results
 
-def get_drawing_details(drawing_ids: List[str]) -> Dict[str, Any]:
+@st.cache_data(ttl=DETAILS_CACHE_TTL, show_spinner=False)
+def get_drawing_details(drawing_ids: Tuple[str, ...]) -> Dict[str, Any]:
     """図面の詳細を取得"""
     if not drawing_ids:
         return {}
     
-    result = supabase.table("drawings").select("*").in_("id", drawing_ids).execute()
+    result = supabase.table("drawings").select("*").in_("id", list(drawing_ids)).execute()
     return {item["id"]: item for item in result.data}
 
-def get_entity_details(entity_ids: List[str]) -> Dict[str, Any]:
+@st.cache_data(ttl=DETAILS_CACHE_TTL, show_spinner=False)
+def get_entity_details(entity_ids: Tuple[str, ...]) -> Dict[str, Any]:
     """エンティティの詳細を取得"""
     if not entity_ids:
         return {}
     
-    result = supabase.table("entities").select("*").in_("id", entity_ids).execute()
+    result = supabase.table("entities").select("*").in_("id", list(entity_ids)).execute()
     return {item["id"]: item for item in result.data}
 
-def render_dxf_viewer(entities: List[Dict], height: int = 400):
-    """DXFビューアーをレンダリング"""
-    # エンティティデータをJSON文字列化
-    entities_json = json.dumps(entities)
+@st.cache_data(ttl=DETAILS_CACHE_TTL, show_spinner=False)
+def get_drawing_entities(drawing_ids: Tuple[str, ...]) -> Dict[str, List[Dict]]:
+    """プレビュー用に複数図面のエンティティを1回の .in_() でまとめて取得し、図面ごとにグループ化
+
+    ビューアーが描画するタイプ・列だけを取得する。
+    """
+    grouped = {drawing_id: [] for drawing_id in drawing_ids}
+    if not drawing_ids:
+        return grouped
+    
+    rows = fetch_all_rows("entities", VIEWER_COLUMNS, in_filters=(
+        ("drawing_id", list(drawing_ids)),
+        ("type", list(VIEWER_FIELDS)),
+    ))
+    for item in rows:
+        grouped[item["drawing_id"]].append(item)
+    return grouped
+
+def fetch_result_details(drawing_ids: List[str], entity_ids: List[str]):
+    """図面・エンティティ・プレビュー用エンティティの取得を並列に実行"""
+    # キャッシュキーを揃えるため、ソート済みタプルで渡す
+    drawing_ids = tuple(sorted(drawing_ids))
+    entity_ids = tuple(sorted(entity_ids))
+    # ワーカースレッドにも実行中スクリプトのコンテキストを渡し、st.cache_data を正しく使えるようにする
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=3,
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+    ) as executor:
+        drawings = executor.submit(get_drawing_details, drawing_ids)
+        entities = executor.submit(get_entity_details, entity_ids)
+        previews = executor.submit(get_drawing_entities, drawing_ids)
+        return drawings.result(), entities.result(), previews.result()
+
+def viewer_entities(entities: List[Dict]) -> List[Dict]:
+    """ビューアーで描画するエンティティだけを、描画に使うフィールドに絞って返す"""
+    slim = []
+    for entity in entities:
+        fields = VIEWER_FIELDS.get(entity.get("type"))
+        if fields:
+            item = {"type": entity["type"]}
+            for field in fields:
+                item[field] = entity.get(field)
+            slim.append(item)
+    return slim
+
+@st.cache_data(ttl=DETAILS_CACHE_TTL, show_spinner=False)
+def build_viewer_html(drawing_id: str, _entities: List[Dict], height: int) -> str:
+    """図面ごとのビューアーHTMLを生成（キャッシュキーは drawing_id と height。_entities はハッシュしない）"""
+    # 描画に必要な分だけJSON文字列化
+    entities_json = orjson.dumps(viewer_entities(_entities)).decode("utf-8")
     
     html_code = f"""
     <div style="width:100%; height:{height}px; border: 1px solid #ddd; border-radius: 8px; overflow: hidden;">
@@ -262,8 +434,20 @@ def render_dxf_viewer(entities: List[Dict], height: int = 400):
         }}
     </script>
     """
-    
-    components.html(html_code, height=height)
+    return html_code
+
+def render_dxf_viewer(drawing_id: str, entities: List[Dict], height: int = 400):
+    """DXFビューアーをレンダリング"""
+    components.html(build_viewer_html(drawing_id, entities, height), height=height)
+
+# payload のトークンに含まれる目印 → 抽出先のフィールド（上から順に判定）
+PAYLOAD_MARKERS = (
+    ("material:", "material"),
+    ("tol:", "tolerance"),
+    ("thread:", "thread"),
+    ("finish:", "finish"),
+    ("type:", "type"),
+)
 
 def extract_info_from_payload(payload: str) -> Dict[str, str]:
     """payloadから情報を抽出"""
@@ -276,27 +460,13 @@ def extract_info_from_payload(payload: str) -> Dict[str, str]:
     }
     
     parts = payload.split()
-    for part in parts:
-        if "material:" in part.lower():
-            idx = parts.index(part)
-            if idx + 1 < len(parts):
-                info["material"] = parts[idx + 1]
-        elif "tol:" in part.lower():
-            idx = parts.index(part)
-            if idx + 1 < len(parts):
-                info["tolerance"] = parts[idx + 1]
-        elif "thread:" in part.lower():
-            idx = parts.index(part)
-            if idx + 1 < len(parts):
-                info["thread"] = parts[idx + 1]
-        elif "finish:" in part.lower():
-            idx = parts.index(part)
-            if idx + 1 < len(parts):
-                info["finish"] = parts[idx + 1]
-        elif "type:" in part.lower():
-            idx = parts.index(part)
-            if idx + 1 < len(parts):
-                info["type"] = parts[idx + 1]
+    for i, part in enumerate(parts[:-1]):
+        # 最初に一致したキーの直後のトークンを値とする
+        lowered = part.lower()
+        for marker, field in PAYLOAD_MARKERS:
+            if marker in lowered:
+                info[field] = parts[i + 1]
+                break
     
     return info
 
@@ -356,9 +526,8 @@ if search_button and query:
             drawing_ids = list(set([r["drawing_id"] for r in results]))
             entity_ids = [r["entity_id"] for r in results if r["entity_id"]]
             
-            # 詳細情報を取得
-            drawings_map = get_drawing_details(drawing_ids)
-            entities_map = get_entity_details(entity_ids)
+            # 詳細情報とプレビュー用エンティティをまとめて取得（結果ごとのクエリは発行しない）
+            drawings_map, entities_map, previews_map = fetch_result_details(drawing_ids, entity_ids)
             
             # 結果を表示
             for idx, result in enumerate(results, 1):
@@ -410,13 +579,11 @@ if search_button and query:
                 
                 # DXFプレビューを表示
                 with st.expander("🖼️ 図面プレビューを表示", expanded=False):
-                    # この図面のすべてのエンティティを取得
-                    drawing_entities_result = supabase.table("entities").select("*").eq(
-                        "drawing_id", result["drawing_id"]
-                    ).execute()
+                    # この図面のすべてのエンティティ（取得済み）
+                    drawing_entities = previews_map.get(result["drawing_id"])
                     
-                    if drawing_entities_result.data:
-                        render_dxf_viewer(drawing_entities_result.data, height=400)
+                    if drawing_entities:
+                        render_dxf_viewer(result["drawing_id"], drawing_entities, height=400)
                     else:
                         st.info("プレビュー情報がありません")
                 
@@ -5,18 +5,173 @@ Supabase/PostgreSQL 接続テストスクリプト
 環境変数やデータベース接続を確認する
 """
 
+import argparse
+import asyncio
+import hashlib
+import json
 import os
+import re
 import sys
+import time
+from pathlib import Path
+from typing import Optional
 
-try:
-    import psycopg2
-except ImportError:
-    print("ERROR: psycopg2 is not installed. Please run: pip install psycopg2-binary", file=sys.stderr)
-    sys.exit(1)
+# 接続文字列のパスワード部分（scheme://user:password@ の password）
+PASSWORD_RE = re.compile(r"(://[^:/@]+):[^@]*@")
 
+# 接続時のサーバー設定（NOTICE を送らせず、確認クエリが固まっても一定時間で打ち切る）
+SERVER_SETTINGS = {"client_min_messages": "error", "statement_timeout": "5000"}
+# --exact の COUNT(*) は大きなテーブルで時間がかかるので打ち切らない
+EXACT_SERVER_SETTINGS = {**SERVER_SETTINGS, "statement_timeout": "0"}
+# 接続確立のタイムアウト（秒）
+CONNECT_TIMEOUT = 10
 
-def test_connection():
-    """データベース接続をテスト"""
+# レコード数の取得式（既定は pg_class の統計値による概算。テーブル全体を走査しない）
+ESTIMATE_COUNT_SQL = "(SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass('public.{table}'))"
+# --exact 用の正確な件数。テーブルがない場合に COUNT がエラーにならないよう、to_regclass で確認してから
+# query_to_xml で件数を取る（CASE の分岐は実行時に評価されるので未作成でも安全）
+EXACT_COUNT_SQL = """CASE WHEN to_regclass('public.{table}') IS NOT NULL THEN
+            (xpath('/row/c/text()', query_to_xml('SELECT COUNT(*) AS c FROM public.{table}', false, true, '')))[1]::text::bigint
+        END"""
+
+# バージョン・テーブルの有無・レコード数・拡張機能を1回の往復でまとめて取得する
+# （テーブルは information_schema のビュー展開・権限チェックを避けて pg_catalog から直接確認。
+#   drawings/entities の有無はサーバー側で判定し、既存テーブルの一覧はどちらかがない場合だけ返す）
+INTROSPECTION_SQL = """
+    WITH public_tables AS (
+        SELECT c.relname::text AS relname
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'public'
+          AND c.relkind IN ('r', 'p')
+    ), required AS (
+        SELECT COUNT(*) = 2 AS ok
+        FROM public_tables
+        WHERE relname IN ('drawings', 'entities')
+    )
+    SELECT
+        version(),
+        (SELECT ok FROM required),
+        CASE WHEN (SELECT ok FROM required) THEN NULL
+             ELSE ARRAY(SELECT relname FROM public_tables ORDER BY relname)
+        END,
+        {drawing_count},
+        {entity_count},
+        ARRAY(
+            SELECT ARRAY[extname::text, extversion]
+            FROM pg_extension
+            WHERE extname IN ('uuid-ossp', 'vector', 'pg_trgm')
+            ORDER BY extname
+        );
+"""
+
+
+def load_driver():
+    """DBドライバと、その接続・データベース由来のエラーを返す
+
+    asyncpg があればバイナリプロトコルで接続する（任意）。なければ psycopg2 を使う。
+    ドライバ（libpq など）の読み込みは重いので、接続する直前まで行わない
+    """
+    try:
+        import asyncpg
+        # asyncpg は接続失敗を OSError で通知する
+        return asyncpg, (OSError, asyncpg.PostgresError)
+    except ImportError:
+        pass
+    try:
+        import psycopg2
+        return psycopg2, (psycopg2.Error,)
+    except ImportError:
+        return None, ()
+
+
+async def fetch_row_async(asyncpg, db_url: str, sql: str, settings: dict) -> tuple:
+    """asyncpg で接続し、1行を取得"""
+    conn = await asyncpg.connect(
+        db_url,
+        timeout=CONNECT_TIMEOUT,
+        # 接続文字列で options が指定されていればそちらを優先
+        server_settings=None if "options=" in db_url else settings,
+        # PgBouncer / Supabase プーラー（トランザクションモード）ではプリペアドステートメントを保持できない
+        statement_cache_size=0,
+    )
+    try:
+        return tuple(await conn.fetchrow(sql))
+    finally:
+        await conn.close()
+
+
+def fetch_row(driver, db_url: str, sql: str, settings: dict = SERVER_SETTINGS) -> tuple:
+    """データベースに接続し、1行を取得（driver は load_driver で読み込んだ asyncpg か psycopg2）"""
+    if driver.__name__ == "asyncpg":
+        return asyncio.run(fetch_row_async(driver, db_url, sql, settings))
+    
+    kwargs = {"connect_timeout": CONNECT_TIMEOUT}
+    if "options=" not in db_url:
+        kwargs["options"] = " ".join(f"-c {name}={value}" for name, value in settings.items())
+    conn = driver.connect(db_url, **kwargs)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            return cur.fetchone()
+    finally:
+        conn.close()
+
+
+def cache_path() -> Path:
+    """確認結果のキャッシュファイル（$XDG_CACHE_HOME/drawingLLM/conn_test.json）"""
+    cache_home = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "drawingLLM" / "conn_test.json"
+
+
+def fetch_row_cached(driver, db_url: str, sql: str, ttl: float, settings: dict = SERVER_SETTINGS) -> tuple:
+    """fetch_row の結果を ttl 秒キャッシュ（キーは接続文字列とクエリのハッシュ）
+
+    戻り値は (行, キャッシュの経過秒数)。DBに問い合わせた場合、経過秒数は None
+    """
+    key = hashlib.blake2b((db_url + sql).encode("utf-8")).hexdigest()
+    path = cache_path()
+    try:
+        cache = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        cache = {}
+    
+    entry = cache.get(key)
+    if entry and time.time() - entry["ts"] < ttl:
+        return tuple(entry["row"]), time.time() - entry["ts"]
+    
+    row = fetch_row(driver, db_url, sql, settings)
+    
+    # 期限切れのエントリを捨てて書き戻す（一時ファイル経由で置き換え）
+    now = time.time()
+    cache = {k: v for k, v in cache.items() if now - v["ts"] < ttl}
+    cache[key] = {"ts": now, "row": list(row)}
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(cache), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError as e:
+        # キャッシュに書けなくてもテスト自体は続ける
+        print(f"⚠ キャッシュを保存できませんでした: {e}")
+    return row, None
+
+
+def format_count(count, exact: bool) -> str:
+    """レコード数を表示用に整形（概算は「約」を付ける）"""
+    if exact:
+        return f"{count:,} 件"
+    if count is None or count < 0:
+        # 一度も ANALYZE されていないテーブルは reltuples が -1
+        return "不明（未 ANALYZE。--exact で正確な件数を取得）"
+    return f"約 {count:,} 件"
+
+
+def test_connection(exact: bool = False, cache_ttl: Optional[float] = None):
+    """データベース接続をテスト（exact=True でレコード数を COUNT(*) で正確に数える）
+
+    cache_ttl を指定すると、その秒数以内の同じ確認結果を再利用し、DBに接続しない
+    """
     
     # 環境変数の確認
     print("=" * 60)
@@ -36,14 +191,7 @@ def test_connection():
         return False
     
     # セキュリティのため、パスワード部分を隠して表示
-    safe_url = db_url
-    if "@" in db_url and ":" in db_url:
-        parts = db_url.split("@")
-        if ":" in parts[0]:
-            user_pass = parts[0].split("://")[1]
-            if ":" in user_pass:
-                user = user_pass.split(":")[0]
-                safe_url = db_url.replace(user_pass, f"{user}:***")
+    safe_url = PASSWORD_RE.sub(r"\1:***@", db_url)
     
     print(f"✓ DATABASE_URL: {safe_url}")
     
@@ -52,92 +200,83 @@ def test_connection():
     print("データベース接続テスト")
     print("=" * 60)
     
+    driver, db_errors = load_driver()
+    if driver is None:
+        print("ERROR: psycopg2 is not installed. Please run: pip install psycopg2-binary", file=sys.stderr)
+        return False
+    
     try:
-        conn = psycopg2.connect(db_url)
-        print("✓ データベースに接続成功")
+        # 接続し、確認に使う情報をまとめて取得
+        count_sql = EXACT_COUNT_SQL if exact else ESTIMATE_COUNT_SQL
+        sql = INTROSPECTION_SQL.format(
+            drawing_count=count_sql.format(table="drawings"),
+            entity_count=count_sql.format(table="entities"),
+        )
+        settings = EXACT_SERVER_SETTINGS if exact else SERVER_SETTINGS
+        if cache_ttl:
+            row, age = fetch_row_cached(driver, db_url, sql, cache_ttl, settings)
+        else:
+            row, age = fetch_row(driver, db_url, sql, settings), None
+        version, has_tables, tables, drawing_count, entity_count, extensions = row
+        
+        if age is None:
+            print(f"✓ データベースに接続成功（{driver.__name__}）")
+        else:
+            print(f"✓ キャッシュされた結果を使用（{age:.0f}秒前の接続結果。接続し直すには --cache-ttl を外す）")
         
         # バージョン確認
-        with conn.cursor() as cur:
-            cur.execute("SELECT version();")
-            version = cur.fetchone()[0]
-            print(f"✓ PostgreSQL バージョン: {version.split(',')[0]}")
+        print(f"✓ PostgreSQL バージョン: {version.partition(',')[0]}")
         
         # テーブルの存在確認
         print("\n" + "=" * 60)
         print("テーブルの確認")
         print("=" * 60)
         
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT table_name 
-                FROM information_schema.tables 
-                WHERE table_schema = 'public' 
-                  AND table_type = 'BASE TABLE'
-                ORDER BY table_name;
-            """)
-            tables = [row[0] for row in cur.fetchall()]
+        if has_tables:
+            print("✓ drawings テーブルが存在します")
+            print("✓ entities テーブルが存在します")
+            
+            # レコード数の確認
+            print(f"\n現在のレコード数:")
+            print(f"  - drawings: {format_count(drawing_count, exact)}")
+            print(f"  - entities: {format_count(entity_count, exact)}")
+        else:
+            print("⚠ drawings または entities テーブルが見つかりません")
+            print("\nスキーマを作成するには:")
+            print("  psql $DATABASE_URL -f schema.sql")
+            print("\nまたは:")
+            print("  cat schema.sql | psql $DATABASE_URL")
             
-            if 'drawings' in tables and 'entities' in tables:
-                print("✓ drawings テーブルが存在します")
-                print("✓ entities テーブルが存在します")
-                
-                # レコード数の確認
-                cur.execute("SELECT COUNT(*) FROM drawings;")
-                drawing_count = cur.fetchone()[0]
-                cur.execute("SELECT COUNT(*) FROM entities;")
-                entity_count = cur.fetchone()[0]
-                
-                print(f"\n現在のレコード数:")
-                print(f"  - drawings: {drawing_count:,} 件")
-                print(f"  - entities: {entity_count:,} 件")
+            if tables:
+                print(f"\n既存のテーブル: {', '.join(tables)}")
             else:
-                print("⚠ drawings または entities テーブルが見つかりません")
-                print("\nスキーマを作成するには:")
-                print("  psql $DATABASE_URL -f schema.sql")
-                print("\nまたは:")
-                print("  cat schema.sql | psql $DATABASE_URL")
-                
-                if tables:
-                    print(f"\n既存のテーブル: {', '.join(tables)}")
-                else:
-                    print("\nテーブルが1つも存在しません")
+                print("\nテーブルが1つも存在しません")
         
         # 拡張機能の確認
         print("\n" + "=" * 60)
         print("PostgreSQL拡張機能の確認")
         print("=" * 60)
         
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT extname, extversion 
-                FROM pg_extension 
-                WHERE extname IN ('uuid-ossp', 'vector', 'pg_trgm')
-                ORDER BY extname;
-            """)
-            extensions = cur.fetchall()
-            
-            ext_dict = {name: version for name, version in extensions}
-            
-            # uuid-ossp
-            if 'uuid-ossp' in ext_dict:
-                print(f"✓ uuid-ossp: {ext_dict['uuid-ossp']} (UUID生成)")
-            else:
-                print("⚠ uuid-ossp: 未インストール (推奨)")
-            
-            # vector (pgvector)
-            if 'vector' in ext_dict:
-                print(f"✓ pgvector: {ext_dict['vector']} (Embedding検索)")
-            else:
-                print("⚠ pgvector: 未インストール (Embedding機能に必要)")
-                print("  インストール: CREATE EXTENSION vector;")
-            
-            # pg_trgm
-            if 'pg_trgm' in ext_dict:
-                print(f"✓ pg_trgm: {ext_dict['pg_trgm']} (全文検索)")
-            else:
-                print("ℹ pg_trgm: 未インストール (オプション)")
+        ext_dict = {name: ext_version for name, ext_version in extensions}
         
-        conn.close()
+        # uuid-ossp
+        if 'uuid-ossp' in ext_dict:
+            print(f"✓ uuid-ossp: {ext_dict['uuid-ossp']} (UUID生成)")
+        else:
+            print("⚠ uuid-ossp: 未インストール (推奨)")
+        
+        # vector (pgvector)
+        if 'vector' in ext_dict:
+            print(f"✓ pgvector: {ext_dict['vector']} (Embedding検索)")
+        else:
+            print("⚠ pgvector: 未インストール (Embedding機能に必要)")
+            print("  インストール: CREATE EXTENSION vector;")
+        
+        # pg_trgm
+        if 'pg_trgm' in ext_dict:
+            print(f"✓ pg_trgm: {ext_dict['pg_trgm']} (全文検索)")
+        else:
+            print("ℹ pg_trgm: 未インストール (オプション)")
         
         print("\n" + "=" * 60)
         print("✓ すべてのテストが完了しました")
@@ -145,7 +284,7 @@ def test_connection():
         
         return True
         
-    except psycopg2.Error as e:
+    except db_errors as e:
         print(f"❌ データベース接続エラー: {e}")
         return False
     except Exception as e:
@@ -154,5 +293,12 @@ def test_connection():
 
 
 if __name__ == "__main__":
-    success = test_connection()
+    ap = argparse.ArgumentParser(description="Supabase/PostgreSQL 接続テスト")
+    ap.add_argument("--exact", action="store_true",
+                    help="レコード数を COUNT(*) で正確に数える（既定は pg_class の統計値による概算）")
+    ap.add_argument("--cache-ttl", type=float, metavar="SECONDS",
+                    help="指定した秒数以内の確認結果があれば再利用し、DBに接続しない（開発ループ・CI向け）")
+    args = ap.parse_args()
+    
+    success = test_connection(exact=args.exact, cache_ttl=args.cache_ttl)
     sys.exit(0 if success else 1)
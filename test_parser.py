@@ -2,43 +2,103 @@
 """
 簡単なパーサーテスト
 """
+import hashlib
+import importlib.util
+import os
+import pickle
 import sys
 from pathlib import Path
-from enhanced_dxf_parser import EnhancedDXFParser
 
-if len(sys.argv) < 2:
-    print("Usage: python3 test_parser.py <dxf_file>")
+# 解析結果のキャッシュ（同じDXF・同じパーサーなら再解析しない）
+CACHE_DIR = Path(__file__).parent / ".cache"
+# キャッシュするパーサーの状態
+PARSER_STATE = (
+    "metadata", "dimensions", "texts", "tables", "annotations", "material_info",
+    "_entity_counts", "_entity_preview",
+)
+
+
+def cache_key(dxf_path: Path, stat) -> str:
+    """DXFファイル（先頭・サイズ・更新時刻）とパーサーのソースからキャッシュキーを作る"""
+    h = hashlib.blake2b(digest_size=8)
+    with dxf_path.open("rb") as f:
+        h.update(f.read(64_000))
+    h.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    # パーサーを変更したらキャッシュを使わない（ソースの場所だけ調べ、ezdxf などは読み込まない）
+    h.update(Path(importlib.util.find_spec("enhanced_dxf_parser").origin).read_bytes())
+    return h.hexdigest()
+
+
+args = [a for a in sys.argv[1:] if a != "--no-cache"]
+if not args:
+    print("Usage: python3 test_parser.py <dxf_file> [--no-cache]")
     sys.exit(1)
 
-print(f"解析開始: {sys.argv[1]}")
+# 解析を始める前に、存在しない・空のファイルを弾く
+try:
+    dxf_path = Path(args[0]).resolve(strict=True)
+    stat = dxf_path.stat()
+except OSError as e:
+    print(f"ERROR: ファイルを開けません: {e}")
+    sys.exit(1)
+if stat.st_size == 0:
+    print(f"ERROR: 空のファイルです: {dxf_path}")
+    sys.exit(1)
+
+cache_file = CACHE_DIR / f"parser_{cache_key(dxf_path, stat)}.pkl"
+
+print(f"解析開始: {dxf_path} ({stat.st_size / 1e6:.1f} MB)")
 print("="*60)
 
-parser = EnhancedDXFParser(Path(sys.argv[1]))
+# ezdxf などの読み込みは重いので、引数を確認してから行う
+from enhanced_dxf_parser import EnhancedDXFParser
+
+parser = None
+if "--no-cache" not in sys.argv and cache_file.exists():
+    # ezdxf.readfile と走査を省略し、前回の解析結果を復元
+    try:
+        with cache_file.open("rb") as f:
+            state = pickle.load(f)
+    except (EOFError, ValueError, pickle.UnpicklingError) as e:
+        # 壊れたキャッシュは無視して解析し直す
+        print(f"(キャッシュを読み込めないため再解析します: {e})")
+    else:
+        parser = EnhancedDXFParser.__new__(EnhancedDXFParser)
+        parser.filepath = dxf_path
+        parser.__dict__.update(state)
+        print(f"(キャッシュから読み込み: {cache_file.name})")
+
+if parser is None:
+    parser = EnhancedDXFParser(dxf_path)
+    parser._extract_metadata()
+    # 寸法・テキスト・エンティティはモデル空間の1回の走査でまとめて抽出
+    parser._extract_all()
+    CACHE_DIR.mkdir(exist_ok=True)
+    # 一時ファイルに書いてから置き換え、中断しても壊れたキャッシュを残さない
+    tmp = cache_file.with_suffix(".tmp")
+    with tmp.open("wb") as f:
+        pickle.dump({name: getattr(parser, name) for name in PARSER_STATE}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, cache_file)
 
-# 個別に各メソッドを呼び出してテスト
+# 各段階の結果を表示
 print("\n1. メタデータ抽出...")
-parser._extract_metadata()
 print(f"   ✓ ファイル名: {parser.metadata['filename']}")
 print(f"   ✓ レイヤー数: {parser.metadata['layer_count']}")
 
 print("\n2. 寸法抽出...")
-parser._extract_dimensions()
 print(f"   ✓ 寸法数: {len(parser.dimensions)}")
 
 print("\n3. テキスト抽出...")
-parser._extract_texts()
 print(f"   ✓ テキスト数: {len(parser.texts)}")
 print(f"   ✓ 材質情報: {len(parser.material_info)}")
 for text in parser.texts[:5]:  # 最初の5件だけ表示
     print(f"      - {text['content']}")
 
 print("\n4. エンティティ抽出...")
-parser._extract_entities()
-print(f"   ✓ エンティティ数: {len(parser.entities)}")
+print(f"   ✓ エンティティ数: {parser.entities_count}")
 summary = parser._summarize_entities()
 for etype, count in summary.items():
     print(f"      - {etype}: {count}件")
 
 print("\n" + "="*60)
 print("完了！")
-